@@ -1,10 +1,39 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from markupsafe import Markup, escape
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
+import base64
+import bisect
+import click
+import codecs
+import csv
+import gzip
+import hashlib
+import html
+import io
+import heapq
+import itertools
+import json
+import math
 import os
+import pathlib
+import random
 import re
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import zipfile
+import zlib
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
@@ -25,6 +54,15 @@ app.config['REMEMBER_COOKIE_SECURE'] = True
 app.config['REMEMBER_COOKIE_HTTPONLY'] = True
 
 db = SQLAlchemy(app)
+
+@db.event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores foreign keys, and so ON DELETE CASCADE, unless asked per connection
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+        cursor.close()
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -38,6 +76,10 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(120), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Per-user change counter; every write stamps the rows it touches with the next value
+    sync_version = db.Column(db.Integer, nullable=False, default=0)
+    # Sync version covered by the last backup download; incremental exports start here
+    export_watermark = db.Column(db.Integer, nullable=False, default=0)
     decks = db.relationship('Deck', backref='user', lazy=True, cascade='all, delete-orphan')
 
     def set_password(self, password):
@@ -59,74 +101,1016 @@ class Deck(db.Model):
     description = db.Column(db.Text)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    cards = db.relationship('Card', backref='deck', lazy=True, cascade='all, delete-orphan')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # Set when the user deletes the deck; its cards are purged in the background later
+    deleted_at = db.Column(db.DateTime)
+    # Template decks are listed for every user to clone
+    is_template = db.Column(db.Boolean, nullable=False, default=False)
+    # The database deletes a deck's cards (ON DELETE CASCADE); they are never loaded for it
+    cards = db.relationship('Card', backref='deck', lazy=True, cascade='all, delete-orphan',
+                            passive_deletes=True, order_by='(Card.position, Card.id)')
+
+    __table_args__ = (
+        db.Index('ix_deck_user_version', 'user_id', 'version'),
+        db.Index('ix_deck_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_deck_user_name', 'user_id', 'name', 'id'),
+        db.Index('ix_deck_deleted_at', 'deleted_at'),
+        db.Index('ix_deck_template_name', 'is_template', 'name', 'id'),
+    )
 
     def __repr__(self):
         return f'<Deck {self.name}>'
 
+    def to_dict(self):
+        """Serialize deck metadata for the JSON API"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'description': self.description,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'version': self.version
+        }
+
+def active_decks():
+    """Deck query that leaves out deleted decks waiting to be purged"""
+    return Deck.query.filter(Deck.deleted_at.is_(None))
+
+def extract_keyword(content):
+    """Extract the most important keyword from a piece of note text"""
+    text = content.lower()
+
+    # Remove common words
+    stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'can', 'this', 'that', 'these', 'those', 'i', 'you', 'he', 'she', 'it', 'we', 'they', 'me', 'him', 'her', 'us', 'them'}
+
+    # Find words that are likely keywords (capitalized, technical terms, longer words)
+    words = re.findall(r'\b[a-zA-Z]+\b', text)
+
+    # Precompute counts and capitalized stretches once so long notes stay linear
+    word_counts = Counter(words)
+    capitalized = set()
+    for run in set(re.findall(r'[A-Z][a-z]*', content)):
+        capitalized.update(run[:end] for end in range(1, len(run) + 1))
+
+    # Score words based on various criteria
+    word_scores = {}
+    for word in words:
+        if word in stop_words or len(word) < 3:
+            continue
+
+        score = 0
+
+        # Longer words are more likely to be keywords
+        score += len(word) * 0.5
+
+        # Words that appear capitalized in original text
+        if word.title() in capitalized:
+            score += 3
+
+        # Words with numbers or special patterns
+        if re.search(r'\d', word) or word.endswith('tion') or word.endswith('ism'):
+            score += 2
+
+        # Frequency (but not too frequent)
+        freq = word_counts[word]
+        if freq == 1:
+            score += 1
+        elif freq > 4:
+            score -= 1
+
+        word_scores[word] = word_scores.get(word, 0) + score
+
+    if not word_scores:
+        # Fallback: return first significant word
+        words = [w for w in words if w not in stop_words and len(w) >= 3]
+        return words[0].title() if words else "Note"
+
+    # Return the highest scoring word
+    keyword = max(word_scores, key=word_scores.get)
+    return keyword.title()
+
+card_tags = db.Table(
+    'card_tag',
+    db.Column('card_id', db.Integer, db.ForeignKey('card.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+    # Primary key serves card -> tags; this one serves tag -> cards for filtering
+    db.Index('ix_card_tag_tag', 'tag_id', 'card_id'),
+)
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(50), nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'name', name='uq_tag_user_name'),
+    )
+
+    def __repr__(self):
+        return f'<Tag {self.name}>'
+
+def normalize_tag(name):
+    """Lowercase, hyphenated tag name ('Friday Quiz' -> 'friday-quiz')"""
+    return '-'.join(name.lower().split()).lstrip('#')[:50]
+
+def parse_tags(text):
+    """Distinct normalized tag names from a comma-separated string"""
+    names = []
+    for part in (text or '').split(','):
+        name = normalize_tag(part)
+        if name and name not in names:
+            names.append(name)
+    return names
+
+def get_or_create_tags(user_id, names):
+    """Tag rows for the given names, creating the missing ones"""
+    if not names:
+        return []
+    tags = {tag.name: tag for tag in Tag.query.filter(Tag.user_id == user_id, Tag.name.in_(names))}
+    for name in names:
+        if name not in tags:
+            tags[name] = Tag(user_id=user_id, name=name)
+            db.session.add(tags[name])
+    return [tags[name] for name in names]
+
+def filter_by_tags(card_query, user_id, names):
+    """Restrict a Card query to cards carrying every one of the tags, resolved in SQL"""
+    if not names:
+        return card_query
+    tagged = (db.select(card_tags.c.card_id)
+              .join(Tag, Tag.id == card_tags.c.tag_id)
+              .where(Tag.user_id == user_id, Tag.name.in_(names))
+              .group_by(card_tags.c.card_id)
+              .having(db.func.count() == len(names)))
+    return card_query.filter(Card.id.in_(tagged))
+
+def deck_tags(user_id, deck_id):
+    """Names of the user's tags used by a deck's cards
+
+    Each of the user's tags is probed for one card in the deck, so the cost
+    follows the number of tags rather than every tag link in the deck.
+    """
+    in_deck = (db.select(card_tags.c.card_id)
+               .join(Card, Card.id == card_tags.c.card_id)
+               .where(card_tags.c.tag_id == Tag.id, Card.deck_id == deck_id)
+               .exists())
+    return [name for name, in db.session.query(Tag.name)
+            .filter(Tag.user_id == user_id, in_deck)
+            .order_by(Tag.name)]
+
+def note_keyword(content):
+    """Keyword stored alongside a note, or None for an empty note"""
+    if not content:
+        return None
+    return extract_keyword(content)[:100]
+
 class Card(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    front = db.Column(db.Text, nullable=True)
-    back = db.Column(db.Text, nullable=True)
-    content = db.Column(db.Text, nullable=True)
+    # The card's own text; read front/back/content, which fall back to the origin's
+    own_front = db.Column('front', db.Text, nullable=True)
+    own_back = db.Column('back', db.Text, nullable=True)
+    own_content = db.Column('content', db.Text, nullable=True)
+    # Set on an unedited clone, whose text is shared with (and read from) this card
+    origin_id = db.Column(db.Integer, db.ForeignKey('card.id'))
     card_type = db.Column(db.String(20), nullable=False, default='flashcard')
-    deck_id = db.Column(db.Integer, db.ForeignKey('deck.id'), nullable=False)
+    # Note keyword, extracted once when the note is saved
+    keyword = db.Column(db.String(100))
+    # Hash of the normalized text, for spotting exact duplicates within a deck
+    content_hash = db.Column(db.String(40))
+    # Fractional index key for user-defined order; compared bytewise on every database.
+    # Unbounded, as keys grow by a character or so with each move into the same gap
+    position = db.Column(db.Text().with_variant(db.Text(collation='C'), 'postgresql'))
+    deck_id = db.Column(db.Integer, db.ForeignKey('deck.id', ondelete='CASCADE'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    tags = db.relationship('Tag', secondary=card_tags, lazy=True, order_by='Tag.name', passive_deletes=True)
+
+    __table_args__ = (
+        db.Index('ix_card_deck_version', 'deck_id', 'version'),
+        db.Index('ix_card_deck_created', 'deck_id', 'created_at', 'id'),
+        db.Index('ix_card_deck_hash', 'deck_id', 'content_hash'),
+        db.Index('ix_card_deck_position', 'deck_id', 'position'),
+        db.Index('ix_card_origin', 'origin_id'),
+    )
 
     def __repr__(self):
         if self.card_type == 'note':
             return f'<Note {self.content[:20]}...>'
         return f'<Card {self.front[:20]}...>'
 
+    def to_dict(self):
+        """Serialize a card for the JSON API"""
+        card_data = {
+            'id': self.id,
+            'deck_id': self.deck_id,
+            'type': self.card_type,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'version': self.version,
+            'position': self.position
+        }
+
+        if self.card_type == 'flashcard':
+            card_data['front'] = self.front
+            card_data['back'] = self.back
+        else:
+            card_data['content'] = self.content
+            card_data['keyword'] = self.extract_keyword()
+
+        return card_data
+
+    def to_study_dict(self):
+        """Front/back pair shown in study mode"""
+        if self.card_type == 'flashcard':
+            return {
+                'id': self.id,
+                'front': self.front,
+                'back': self.back,
+                'type': 'flashcard'
+            }
+        # Note cards are studied from their auto-extracted keyword
+        return {
+            'id': self.id,
+            'front': self.extract_keyword(),
+            'back': self.content,
+            'type': 'note'
+        }
+
+    def answer_prompt(self):
+        """Prompt and expected answer for type-the-answer mode"""
+        if self.card_type == 'flashcard':
+            return self.front, self.back
+        # Note cards ask for their keyword with it blanked out of the note
+        keyword = self.extract_keyword()
+        prompt = re.sub(re.escape(keyword), '_____', self.content, flags=re.IGNORECASE)
+        return prompt, keyword
+
     def extract_keyword(self):
         """Extract the most important keyword from note content"""
         if self.card_type != 'note' or not self.content:
             return None
+        # Rows saved before keywords were stored fall back to extracting on the fly
+        return self.keyword or extract_keyword(self.content)
+
+_origin_card = Card.__table__.alias('origin_card')
+
+def origin_text(column):
+    """A text column of the card's origin, as a correlated subquery"""
+    return (db.select(_origin_card.c[column])
+            .where(_origin_card.c.id == Card.__table__.c.origin_id)
+            .scalar_subquery())
+
+def shared_text(column):
+    """A card's own text, or its origin's while it is an unedited clone"""
+    return db.column_property(db.case((Card.__table__.c.origin_id.is_(None), Card.__table__.c[column]),
+                                      else_=origin_text(column)))
+
+Card.front = shared_text('front')
+Card.back = shared_text('back')
+Card.content = shared_text('content')
+
+def materialize_clones(origin_ids):
+    """Give unedited clones of these cards their own copy of the text, before the cards change or go"""
+    cards = Card.__table__
+    db.session.execute(
+        db.update(cards)
+        .where(cards.c.origin_id.in_(origin_ids))
+        .values(front=origin_text('front'), back=origin_text('back'),
+                content=origin_text('content'), origin_id=None)
+    )
+
+class Tombstone(db.Model):
+    """Record of a deleted deck or card so other devices can catch up"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    object_type = db.Column(db.String(20), nullable=False)  # 'deck' or 'card'
+    object_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-        text = self.content.lower()
-
-        # Remove common words
-        stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'can', 'this', 'that', 'these', 'those', 'i', 'you', 'he', 'she', 'it', 'we', 'they', 'me', 'him', 'her', 'us', 'them'}
+    __table_args__ = (
+        db.Index('ix_tombstone_user_version', 'user_id', 'version'),
+    )
 
-        # Find words that are likely keywords (capitalized, technical terms, longer words)
-        words = re.findall(r'\b[a-zA-Z]+\b', text)
+    def __repr__(self):
+        return f'<Tombstone {self.object_type} {self.object_id}>'
+
+def bump_sync_version(user_id):
+    """Advance the user's change counter and return the new value"""
+    db.session.execute(
+        db.update(User)
+        .where(User.id == user_id)
+        .values(sync_version=User.sync_version + 1)
+    )
+    return db.session.execute(
+        db.select(User.sync_version).where(User.id == user_id)
+    ).scalar_one()
+
+def mark_changed(user_id, *objects):
+    """Stamp decks/cards with the user's next sync version"""
+    version = bump_sync_version(user_id)
+    for obj in objects:
+        obj.version = version
+    return version
+
+def record_deletion(user_id, version, object_type, object_id):
+    """Leave a tombstone for a deleted deck or card"""
+    db.session.add(Tombstone(user_id=user_id, object_type=object_type,
+                             object_id=object_id, version=version))
+
+class UserStats(db.Model):
+    """Running library totals for the profile page, kept in step by every write path"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    deck_count = db.Column(db.Integer, nullable=False, default=0)
+    flashcard_count = db.Column(db.Integer, nullable=False, default=0)
+    note_count = db.Column(db.Integer, nullable=False, default=0)
+    last_activity = db.Column(db.DateTime)
+
+    @property
+    def card_count(self):
+        return self.flashcard_count + self.note_count
 
-        # Score words based on various criteria
-        word_scores = {}
-        for word in words:
-            if word in stop_words or len(word) < 3:
-                continue
+    def __repr__(self):
+        return f'<UserStats {self.user_id}>'
+
+def adjust_user_stats(user_id, decks=0, flashcards=0, notes=0):
+    """Apply deltas to the user's stats row inside the current transaction"""
+    # A missing row is left alone; profile() rebuilds it from scratch on first view
+    db.session.execute(
+        db.update(UserStats)
+        .where(UserStats.user_id == user_id)
+        .values(deck_count=UserStats.deck_count + decks,
+                flashcard_count=UserStats.flashcard_count + flashcards,
+                note_count=UserStats.note_count + notes,
+                last_activity=datetime.utcnow())
+    )
+
+def deck_card_type_counts(deck_id):
+    """(flashcards, notes) in a deck, counted in one query"""
+    counts = dict(db.session.query(Card.card_type, db.func.count(Card.id))
+                  .filter(Card.deck_id == deck_id)
+                  .group_by(Card.card_type).all())
+    return counts.get('flashcard', 0), counts.get('note', 0)
+
+def rebuild_user_stats(user_ids=None):
+    """Recount stats rows from the deck and card tables (all users by default)
+
+    Rows are locked before they are recounted in place, so an
+    adjust_user_stats delta committed meanwhile is either already in the
+    count or applied on top of it, never overwritten.
+    """
+    users = db.select(User.id).where(~db.exists().where(UserStats.user_id == User.id))
+    if user_ids is not None:
+        users = users.where(User.id.in_(user_ids))
+    dialect_insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    db.session.execute(
+        dialect_insert(UserStats)
+        .from_select(['user_id', 'deck_count', 'flashcard_count', 'note_count'],
+                     users.add_columns(db.literal(0), db.literal(0), db.literal(0)))
+        .on_conflict_do_nothing(index_elements=['user_id'])
+    )
+
+    stats = db.select(UserStats.user_id)
+    if user_ids is not None:
+        stats = stats.where(UserStats.user_id.in_(user_ids))
+    db.session.execute(stats.with_for_update())
+
+    live_decks = db.and_(Deck.user_id == UserStats.user_id, Deck.deleted_at.is_(None))
+    deck_count = db.select(db.func.count(Deck.id)).where(live_decks).scalar_subquery()
+    last_deck_change = db.select(db.func.max(Deck.updated_at)).where(live_decks).scalar_subquery()
+
+    def card_aggregate(aggregate, *conditions):
+        return (db.select(aggregate).select_from(Card).join(Deck, Card.deck_id == Deck.id)
+                .where(live_decks, *conditions).scalar_subquery())
+
+    # Any card implies a live deck, so only the card side can be NULL on its own
+    greatest = db.func.greatest if db.engine.dialect.name == 'postgresql' else db.func.max
+    last_card_change = db.func.coalesce(card_aggregate(db.func.max(Card.updated_at)), last_deck_change)
+    update = db.update(UserStats).values(
+        deck_count=deck_count,
+        flashcard_count=card_aggregate(db.func.count(Card.id), Card.card_type != 'note'),
+        note_count=card_aggregate(db.func.count(Card.id), Card.card_type == 'note'),
+        last_activity=greatest(last_card_change, last_deck_change),
+    )
+    if user_ids is not None:
+        update = update.where(UserStats.user_id.in_(user_ids))
+    return db.session.execute(update).rowcount
+
+class StudyEvent(db.Model):
+    """One answered card; deck/card ids are plain integers so history outlives deletions"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    deck_id = db.Column(db.Integer, nullable=False)
+    card_id = db.Column(db.Integer)
+    correct = db.Column(db.Boolean, nullable=False)
+    studied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_study_event_user_time', 'user_id', 'studied_at'),
+    )
+
+class StudyRollup(db.Model):
+    """Answers per user, deck and (UTC) day, maintained as events are recorded"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    deck_id = db.Column(db.Integer, primary_key=True)
+    reviews = db.Column(db.Integer, nullable=False, default=0)
+    correct = db.Column(db.Integer, nullable=False, default=0)
+
+def record_study_result(user_id, deck_id, card_id, correct):
+    """Log an answer and fold it into today's rollup row"""
+    now = datetime.utcnow()
+    db.session.add(StudyEvent(user_id=user_id, deck_id=deck_id, card_id=card_id,
+                              correct=correct, studied_at=now))
+    # One upsert, so two first answers of the day can't both try to insert the row
+    dialect_insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    correct_count = 1 if correct else 0
+    db.session.execute(
+        dialect_insert(StudyRollup)
+        .values(user_id=user_id, day=now.date(), deck_id=deck_id, reviews=1, correct=correct_count)
+        .on_conflict_do_update(index_elements=['user_id', 'day', 'deck_id'],
+                               set_={'reviews': StudyRollup.reviews + 1,
+                                     'correct': StudyRollup.correct + correct_count})
+    )
+
+def rebuild_study_rollups():
+    """Recompute every rollup row from the raw study events"""
+    day = db.func.date(StudyEvent.studied_at)
+    totals = (db.select(StudyEvent.user_id, day, StudyEvent.deck_id,
+                        db.func.count(StudyEvent.id),
+                        db.func.sum(db.case((StudyEvent.correct, 1), else_=0)))
+              .group_by(StudyEvent.user_id, day, StudyEvent.deck_id))
+    db.session.execute(db.delete(StudyRollup))
+    db.session.execute(db.insert(StudyRollup).from_select(
+        ['user_id', 'day', 'deck_id', 'reviews', 'correct'], totals))
+    return db.session.query(StudyRollup).count()
+
+# Heatmap shading: reviews needed for each level above zero
+HEATMAP_LEVELS = (1, 10, 25, 50)
+
+def study_heatmap(user_id, today):
+    """Weeks (Sunday first) of (day, reviews, level) covering the past year"""
+    start = today - timedelta(days=364)
+    start -= timedelta(days=(start.weekday() + 1) % 7)
+
+    # At most one grouped row per day
+    day_totals = dict(db.session.query(StudyRollup.day, db.func.sum(StudyRollup.reviews))
+                      .filter(StudyRollup.user_id == user_id, StudyRollup.day >= start)
+                      .group_by(StudyRollup.day))
+
+    weeks = []
+    day = start
+    while day <= today:
+        week = []
+        for _ in range(7):
+            reviews = day_totals.get(day, 0) if day <= today else None
+            level = sum(1 for threshold in HEATMAP_LEVELS if reviews and reviews >= threshold)
+            week.append((day, reviews, level))
+            day += timedelta(days=1)
+        weeks.append(week)
+    return weeks
+
+RETENTION_WEEKS = 12
+
+def deck_retention(user_id, today):
+    """Per-deck share of correct answers for each of the last RETENTION_WEEKS weeks"""
+    start = today - timedelta(weeks=RETENTION_WEEKS) + timedelta(days=1)
+    rows = (db.session.query(StudyRollup.deck_id, StudyRollup.day, StudyRollup.reviews, StudyRollup.correct)
+            .filter(StudyRollup.user_id == user_id, StudyRollup.day >= start))
+
+    weekly = {}
+    for deck_id, day, reviews, correct in rows:
+        week = (day - start).days // 7
+        totals = weekly.setdefault(deck_id, [[0, 0] for _ in range(RETENTION_WEEKS)])
+        totals[week][0] += reviews
+        totals[week][1] += correct
+
+    names = dict(db.session.query(Deck.id, Deck.name).filter(Deck.id.in_(list(weekly)), Deck.deleted_at.is_(None)))
+    curves = []
+    for deck_id, totals in weekly.items():
+        if deck_id not in names:
+            continue
+        points = [round(100 * correct / reviews) if reviews else None for reviews, correct in totals]
+        curves.append({'deck': names[deck_id], 'points': points})
+    return sorted(curves, key=lambda curve: curve['deck'])
+
+class CardSignatureBand(db.Model):
+    """One LSH band of a note's MinHash signature; notes sharing a bucket are near-duplicate candidates"""
+    card_id = db.Column(db.Integer, db.ForeignKey('card.id', ondelete='CASCADE'), primary_key=True)
+    band = db.Column(db.Integer, primary_key=True)
+    deck_id = db.Column(db.Integer, db.ForeignKey('deck.id', ondelete='CASCADE'), nullable=False)
+    bucket = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_signature_band_lookup', 'deck_id', 'band', 'bucket'),
+    )
+
+def card_content_hash(card_type, front=None, back=None, content=None):
+    """Hash of a card's normalized text; equal hashes mean the same card"""
+    if card_type == 'note':
+        text = normalize_answer(content)
+    else:
+        text = normalize_answer(front) + '\x1f' + normalize_answer(back)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# MinHash/LSH parameters: 8 bands of 4 rows flag notes above roughly 60% shingle overlap
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20240917)
+MINHASH_PERMUTATIONS = [(_minhash_rng.randrange(1, MINHASH_PRIME), _minhash_rng.randrange(MINHASH_PRIME))
+                        for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+# Candidates must really share this much of their text to be reported
+NEAR_DUPLICATE_SIMILARITY = 0.8
+
+def note_shingles(content):
+    """Overlapping three-word shingles of a note (the words themselves for short notes)"""
+    words = normalize_answer(content).split()
+    if len(words) < 3:
+        return set(words)
+    return {' '.join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+def signature_buckets(shingles):
+    """LSH bucket per band of the MinHash signature of a shingle set"""
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+    signature = [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_PERMUTATIONS]
+    buckets = []
+    for band in range(MINHASH_BANDS):
+        rows = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+        buckets.append(zlib.crc32(repr(rows).encode()) & 0x7fffffff)
+    return buckets
+
+def signature_band_rows(card_id, deck_id, content):
+    """CardSignatureBand rows for a note (none for an empty one)"""
+    shingles = note_shingles(content)
+    if not shingles:
+        return []
+    return [{'card_id': card_id, 'deck_id': deck_id, 'band': band, 'bucket': bucket}
+            for band, bucket in enumerate(signature_buckets(shingles))]
+
+def find_duplicate(deck_id, card_type, content_hash):
+    """An identical card already in the deck, via the (deck_id, content_hash) index"""
+    return Card.query.filter_by(deck_id=deck_id, card_type=card_type,
+                                content_hash=content_hash).first()
+
+def find_near_duplicate_note(deck_id, content):
+    """A note in the deck sharing most of its text with content, found through the LSH buckets"""
+    shingles = note_shingles(content)
+    if not shingles:
+        return None
+    buckets = signature_buckets(shingles)
+    candidate_ids = db.select(CardSignatureBand.card_id).where(
+        CardSignatureBand.deck_id == deck_id,
+        db.tuple_(CardSignatureBand.band, CardSignatureBand.bucket).in_(list(enumerate(buckets)))
+    ).distinct()
+
+    for candidate in Card.query.filter(Card.id.in_(candidate_ids)):
+        other = note_shingles(candidate.content)
+        if len(shingles & other) / len(shingles | other) >= NEAR_DUPLICATE_SIMILARITY:
+            return candidate
+    return None
+
+# Fractional index keys: strings that sort in card order and always leave room
+# between neighbours, so moving a card rewrites only that card. Keys are a
+# variable-length integer part (its head letter encodes its length) followed
+# by a base-62 fraction; appending increments the integer part, keeping keys short.
+POSITION_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+SMALLEST_POSITION_INTEGER = 'A' + POSITION_DIGITS[0] * 26
+
+def _position_midpoint(a, b):
+    """Fraction strictly between fractions a and b (b=None means 1)"""
+    zero = POSITION_DIGITS[0]
+    if b:
+        # Drop the common prefix, padding a with zeros
+        n = 0
+        while (a[n] if n < len(a) else zero) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _position_midpoint(a[n:], b[n:])
+
+    digit_a = POSITION_DIGITS.index(a[0]) if a else 0
+    digit_b = POSITION_DIGITS.index(b[0]) if b is not None else len(POSITION_DIGITS)
+    if digit_b - digit_a > 1:
+        return POSITION_DIGITS[(digit_a + digit_b + 1) // 2]
+    if b and len(b) > 1:
+        return b[:1]
+    return POSITION_DIGITS[digit_a] + _position_midpoint(a[1:], None)
+
+def _position_integer_length(head):
+    if 'a' <= head <= 'z':
+        return ord(head) - ord('a') + 2
+    if 'A' <= head <= 'Z':
+        return ord('Z') - ord(head) + 2
+    raise ValueError(f'invalid position key head: {head!r}')
+
+def _position_integer_part(key):
+    length = _position_integer_length(key[0])
+    if length > len(key):
+        raise ValueError(f'invalid position key: {key!r}')
+    return key[:length]
+
+def _increment_position_integer(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        digit = POSITION_DIGITS.index(digits[i]) + 1
+        if digit < len(POSITION_DIGITS):
+            digits[i] = POSITION_DIGITS[digit]
+            return head + ''.join(digits)
+        digits[i] = POSITION_DIGITS[0]
+    if head == 'Z':
+        return 'a' + POSITION_DIGITS[0]
+    if head == 'z':
+        return None
+    head = chr(ord(head) + 1)
+    if head > 'a':
+        digits.append(POSITION_DIGITS[0])
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+def _decrement_position_integer(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        digit = POSITION_DIGITS.index(digits[i]) - 1
+        if digit >= 0:
+            digits[i] = POSITION_DIGITS[digit]
+            return head + ''.join(digits)
+        digits[i] = POSITION_DIGITS[-1]
+    if head == 'a':
+        return 'Z' + POSITION_DIGITS[-1]
+    if head == 'A':
+        return None
+    head = chr(ord(head) - 1)
+    if head < 'Z':
+        digits.append(POSITION_DIGITS[-1])
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+def position_between(a, b):
+    """Position key sorting strictly between a and b (None means open-ended)"""
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f'{a!r} is not before {b!r}')
+
+    if a is None:
+        if b is None:
+            return 'a' + POSITION_DIGITS[0]
+        integer_b = _position_integer_part(b)
+        fraction_b = b[len(integer_b):]
+        if integer_b == SMALLEST_POSITION_INTEGER:
+            return integer_b + _position_midpoint('', fraction_b)
+        if integer_b < b:
+            return integer_b
+        decremented = _decrement_position_integer(integer_b)
+        if decremented is None:
+            raise ValueError('cannot place a card before the first position')
+        return decremented
+
+    integer_a = _position_integer_part(a)
+    fraction_a = a[len(integer_a):]
+    if b is None:
+        incremented = _increment_position_integer(integer_a)
+        return integer_a + _position_midpoint(fraction_a, None) if incremented is None else incremented
+
+    integer_b = _position_integer_part(b)
+    fraction_b = b[len(integer_b):]
+    if integer_a == integer_b:
+        return integer_a + _position_midpoint(fraction_a, fraction_b)
+    incremented = _increment_position_integer(integer_a)
+    if incremented is not None and incremented < b:
+        return incremented
+    return integer_a + _position_midpoint(fraction_a, None)
+
+def positions_after(last, count):
+    """count consecutive position keys after last (None for an empty deck)"""
+    keys = []
+    for _ in range(count):
+        last = position_between(last, None)
+        keys.append(last)
+    return keys
+
+def lock_deck(deck_id):
+    """Lock a deck's row until commit
+
+    Taken before handing out position keys, so concurrent appends and moves
+    in one deck queue up instead of computing the same key. SQLite has no row
+    locks and starts transactions deferred, so there a no-op write takes the
+    database write lock before the last key is read.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(db.text('UPDATE deck SET id = id WHERE id = :id'), {'id': deck_id})
+    else:
+        db.session.execute(db.select(Deck.id).where(Deck.id == deck_id).with_for_update())
+
+def last_position(deck_id):
+    """Highest position in a deck, read from the (deck_id, position) index; locks the deck"""
+    lock_deck(deck_id)
+    return (db.session.query(Card.position)
+            .filter(Card.deck_id == deck_id, Card.position.isnot(None))
+            .order_by(Card.position.desc())
+            .limit(1).scalar())
+
+def backfill_positions(deck_id=None):
+    """Give cards saved before manual ordering a position, keeping creation order"""
+    query = db.session.query(Card.deck_id).filter(Card.position.is_(None)).distinct()
+    if deck_id is not None:
+        query = query.filter(Card.deck_id == deck_id)
+
+    updated = 0
+    for unpositioned_deck_id, in query.all():
+        card_ids = [card_id for card_id, in db.session.query(Card.id)
+                    .filter(Card.deck_id == unpositioned_deck_id, Card.position.is_(None))
+                    .order_by(Card.created_at, Card.id)]
+        keys = positions_after(last_position(unpositioned_deck_id), len(card_ids))
+        db.session.execute(db.update(Card), [{'id': card_id, 'position': key}
+                                             for card_id, key in zip(card_ids, keys)])
+        updated += len(card_ids)
+    return updated
+
+def untie_positions(deck_id, position):
+    """Spread cards sharing a position key over distinct keys, keeping id order
+
+    Cards appended concurrently before appends took the deck lock could end
+    up with equal keys, which leave no room to move a card between them.
+    """
+    tied = Card.query.filter_by(deck_id=deck_id, position=position).order_by(Card.id).all()
+    if len(tied) < 2:
+        return
+    following = (db.session.query(Card.position)
+                 .filter(Card.deck_id == deck_id, Card.position > position)
+                 .order_by(Card.position).limit(1).scalar())
+    for card in tied[1:]:
+        position = card.position = position_between(position, following)
+    db.session.flush()
+
+# Rows per executemany when cards are inserted in bulk
+CARD_INSERT_BATCH = 1000
+
+def card_row(deck_id, version, card_type, front=None, back=None, content=None):
+    """Column values for a card inserted through insert_card_rows()"""
+    return {
+        'deck_id': deck_id,
+        'version': version,
+        'card_type': card_type,
+        'front': front,
+        'back': back,
+        'content': content,
+        'keyword': note_keyword(content) if card_type == 'note' else None,
+        'content_hash': card_content_hash(card_type, front, back, content)
+    }
 
-            score = 0
+def insert_card_rows(user_id, rows, skip_duplicates=True, batch_size=CARD_INSERT_BATCH, progress=None):
+    """Insert card rows from any iterable, one batched statement per chunk
+
+    Exact duplicates (already in the target deck, or earlier in rows) are
+    skipped with one indexed lookup per batch. Keeps the user's stats and
+    the note LSH index in step. Cards are appended after each deck's last
+    position. Each inserted row gets its new 'id'; progress(inserted so
+    far) is called after each batch. Returns the number of cards inserted.
+    """
+    seen = set()
+    last_positions = {}
+    total = 0
+
+    def flush(batch):
+        if skip_duplicates:
+            existing = set(db.session.execute(
+                db.select(Card.deck_id, Card.content_hash).where(
+                    Card.deck_id.in_({row['deck_id'] for row in batch}),
+                    Card.content_hash.in_({row['content_hash'] for row in batch}))
+            ).all())
+            fresh = []
+            for row in batch:
+                key = (row['deck_id'], row['content_hash'])
+                if key not in existing and key not in seen:
+                    seen.add(key)
+                    fresh.append(row)
+            batch = fresh
+        if not batch:
+            return 0
+
+        for row in batch:
+            if row['deck_id'] not in last_positions:
+                last_positions[row['deck_id']] = last_position(row['deck_id'])
+            row['position'] = last_positions[row['deck_id']] = position_between(
+                last_positions[row['deck_id']], None)
+
+        # Positions are unique within a deck, so they tie the returned ids back
+        # to rows; ordered RETURNING can fall back to a statement per row
+        inserted = db.session.execute(
+            db.insert(Card.__table__).returning(Card.id, Card.deck_id, Card.position), batch
+        ).all()
+        card_ids = {(deck_id, position): card_id for card_id, deck_id, position in inserted}
+
+        bands = []
+        notes = 0
+        for row in batch:
+            row['id'] = card_ids[(row['deck_id'], row['position'])]
+            if row['card_type'] == 'note':
+                notes += 1
+                bands.extend(signature_band_rows(row['id'], row['deck_id'], row['content']))
+        if bands:
+            db.session.execute(db.insert(CardSignatureBand), bands)
+
+        adjust_user_stats(user_id, flashcards=len(batch) - notes, notes=notes)
+        return len(batch)
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            total += flush(batch)
+            batch = []
+            if progress:
+                progress(total)
+    if batch:
+        total += flush(batch)
+    return total
+
+# Snippet highlight markers, swapped for <mark> tags once the snippet is escaped
+HIGHLIGHT_OPEN = '\ue000'
+HIGHLIGHT_CLOSE = '\ue001'
+
+def highlight_snippet(snippet):
+    """HTML-safe snippet with the matched terms wrapped in <mark>"""
+    escaped = str(escape(snippet or ''))
+    return Markup(escaped.replace(HIGHLIGHT_OPEN, '<mark>').replace(HIGHLIGHT_CLOSE, '</mark>'))
+
+class SearchBackend:
+    """Ranked search over a user's cards; one subclass per database"""
+
+    def setup_statements(self):
+        """DDL that creates and syncs the search index (idempotent)"""
+        return []
+
+    def rebuild_statements(self):
+        """DDL that repopulates the index from existing cards"""
+        return []
+
+    def is_installed(self):
+        return True
 
-            # Longer words are more likely to be keywords
-            score += len(word) * 0.5
+    def search(self, user_id, query, limit):
+        """[(card_id, snippet)] best match first"""
+        raise NotImplementedError
+
+class SqliteFtsSearch(SearchBackend):
+    """FTS5 external-content table kept in sync with card by triggers"""
+
+    def setup_statements(self):
+        return [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS card_fts USING fts5("
+            "front, back, content, content='card', content_rowid='id')",
+            "CREATE TRIGGER IF NOT EXISTS card_fts_insert AFTER INSERT ON card BEGIN "
+            "INSERT INTO card_fts(rowid, front, back, content) "
+            "VALUES (new.id, new.front, new.back, new.content); END",
+            "CREATE TRIGGER IF NOT EXISTS card_fts_delete AFTER DELETE ON card BEGIN "
+            "INSERT INTO card_fts(card_fts, rowid, front, back, content) "
+            "VALUES ('delete', old.id, old.front, old.back, old.content); END",
+            "CREATE TRIGGER IF NOT EXISTS card_fts_update AFTER UPDATE OF front, back, content ON card BEGIN "
+            "INSERT INTO card_fts(card_fts, rowid, front, back, content) "
+            "VALUES ('delete', old.id, old.front, old.back, old.content); "
+            "INSERT INTO card_fts(rowid, front, back, content) "
+            "VALUES (new.id, new.front, new.back, new.content); END",
+        ]
 
-            # Words that appear capitalized in original text
-            if word.title() in self.content:
-                score += 3
+    def rebuild_statements(self):
+        return ["INSERT INTO card_fts(card_fts) VALUES ('rebuild')"]
 
-            # Words with numbers or special patterns
-            if re.search(r'\d', word) or word.endswith('tion') or word.endswith('ism'):
-                score += 2
+    def is_installed(self):
+        return db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'card_fts'"
+        )).first() is not None
 
-            # Frequency (but not too frequent)
-            freq = words.count(word)
-            if freq == 1:
-                score += 1
-            elif freq > 4:
-                score -= 1
+    @staticmethod
+    def match_expression(query):
+        """Quote each word so user input can't use FTS syntax; the last word matches as a prefix"""
+        words = re.findall(r'\w+', query)
+        if not words:
+            return None
+        terms = ['"' + word + '"' for word in words]
+        terms[-1] += '*'
+        return ' '.join(terms)
 
-            word_scores[word] = word_scores.get(word, 0) + score
+    def search(self, user_id, query, limit):
+        match = self.match_expression(query)
+        if match is None:
+            return []
+        rows = db.session.execute(db.text(
+            "SELECT card.id, snippet(card_fts, -1, :open, :close, '…', 12) "
+            "FROM card_fts "
+            "JOIN card ON card.id = card_fts.rowid OR card.origin_id = card_fts.rowid "
+            "JOIN deck ON deck.id = card.deck_id "
+            "WHERE card_fts MATCH :match AND deck.user_id = :user_id AND deck.deleted_at IS NULL "
+            "ORDER BY bm25(card_fts) LIMIT :limit"
+        ), {'open': HIGHLIGHT_OPEN, 'close': HIGHLIGHT_CLOSE, 'match': match,
+            'user_id': user_id, 'limit': limit})
+        return [(card_id, snippet) for card_id, snippet in rows]
+
+class PostgresSearch(SearchBackend):
+    """Generated tsvector column on card with a GIN index"""
+
+    def setup_statements(self):
+        return [
+            "ALTER TABLE card ADD COLUMN IF NOT EXISTS search_vector tsvector "
+            "GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('english', coalesce(front, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(back, '')), 'B') || "
+            "setweight(to_tsvector('english', coalesce(content, '')), 'C')) STORED",
+            "CREATE INDEX IF NOT EXISTS ix_card_search_vector ON card USING GIN (search_vector)",
+        ]
 
-        if not word_scores:
-            # Fallback: return first significant word
-            words = [w for w in words if w not in stop_words and len(w) >= 3]
-            return words[0].title() if words else "Note"
+    def is_installed(self):
+        return db.session.execute(db.text(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = 'card' AND column_name = 'search_vector'"
+        )).first() is not None
 
-        # Return the highest scoring word
-        keyword = max(word_scores, key=word_scores.get)
-        return keyword.title()
+    def search(self, user_id, query, limit):
+        if not query.strip():
+            return []
+        rows = db.session.execute(db.text(
+            "SELECT card.id, ts_headline('english', "
+            "concat_ws(' ', source.front, source.back, source.content), q, :options) "
+            "FROM card source "
+            "JOIN card ON card.id = source.id OR card.origin_id = source.id "
+            "JOIN deck ON deck.id = card.deck_id, "
+            "websearch_to_tsquery('english', :query) q "
+            "WHERE deck.user_id = :user_id AND deck.deleted_at IS NULL AND source.search_vector @@ q "
+            "ORDER BY ts_rank_cd(source.search_vector, q) DESC LIMIT :limit"
+        ), {'options': f'StartSel={HIGHLIGHT_OPEN}, StopSel={HIGHLIGHT_CLOSE}, MaxFragments=2',
+            'query': query, 'user_id': user_id, 'limit': limit})
+        return [(card_id, snippet) for card_id, snippet in rows]
+
+class LikeSearch(SearchBackend):
+    """Unindexed fallback for databases whose search index isn't set up yet"""
+
+    def search(self, user_id, query, limit):
+        words = re.findall(r'\w+', query)
+        if not words:
+            return []
+        cards = Card.query.join(Deck).filter(Deck.user_id == user_id, Deck.deleted_at.is_(None))
+        for word in words:
+            pattern = f'%{word}%'
+            cards = cards.filter(db.or_(Card.front.ilike(pattern), Card.back.ilike(pattern),
+                                        Card.content.ilike(pattern)))
+        results = []
+        for card in cards.order_by(Card.created_at.desc()).limit(limit):
+            text = ' '.join(part for part in (card.front, card.back, card.content) if part)
+            results.append((card.id, text[:200]))
+        return results
+
+def search_backend_for(dialect_name):
+    """Search backend matching a database dialect"""
+    if dialect_name == 'sqlite':
+        return SqliteFtsSearch()
+    if dialect_name == 'postgresql':
+        return PostgresSearch()
+    return LikeSearch()
+
+SEARCH_INDEX_RECHECK = 60  # seconds between looks for the index while falling back to LIKE
+
+_search_backend = None
+_search_fallback_until = 0
+
+def get_search_backend():
+    """Search backend for this process, falling back to LIKE until the index exists
+
+    Only an installed backend is cached; while on the fallback the index is
+    looked for again every SEARCH_INDEX_RECHECK seconds, so running
+    init-search is picked up without restarting the workers.
+    """
+    global _search_backend, _search_fallback_until
+    if _search_backend is not None:
+        return _search_backend
+    if time.monotonic() < _search_fallback_until:
+        return LikeSearch()
+    backend = search_backend_for(db.engine.dialect.name)
+    if backend.is_installed():
+        _search_backend = backend
+        return backend
+    _search_fallback_until = time.monotonic() + SEARCH_INDEX_RECHECK
+    return LikeSearch()
+
+def install_search_index(connection, rebuild=False):
+    """Create the search index for the connection's database"""
+    backend = search_backend_for(connection.dialect.name)
+    statements = backend.setup_statements()
+    if rebuild:
+        statements += backend.rebuild_statements()
+    for statement in statements:
+        connection.execute(db.text(statement))
+
+@db.event.listens_for(Card.__table__, 'after_create')
+def create_search_index(target, connection, **kw):
+    install_search_index(connection, rebuild=True)
+
+@db.event.listens_for(Card.__table__, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(db.text('DROP TABLE IF EXISTS card_fts'))
 
 class FunFact(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -184,17 +1168,324 @@ def seed_fun_facts():
 
     db.session.commit()
 
+def with_card_counts(deck_query):
+    """Turn a Deck query into (deck, card_count) rows
+
+    The count is a correlated subquery, so it is only evaluated for the
+    decks that actually make it onto the page.
+    """
+    card_count = (db.select(db.func.count(Card.id))
+                  .where(Card.deck_id == Deck.id)
+                  .correlate(Deck)
+                  .scalar_subquery()
+                  .label('card_count'))
+    return deck_query.add_columns(card_count)
+
+def encode_cursor(values):
+    """Opaque page token for a keyset position"""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(token, columns):
+    """Keyset position from a page token, or None if it is missing or malformed"""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            return None
+        position = []
+        for column, value in zip(columns, values):
+            python_type = column.type.python_type
+            if python_type is datetime:
+                value = datetime.fromisoformat(value)
+            # A tampered token must not reach the query as a dict, list or bool
+            elif not isinstance(value, python_type) or isinstance(value, bool):
+                return None
+            # Beyond a 64-bit column the driver overflows rather than comparing
+            elif python_type is int and not -2 ** 63 <= value < 2 ** 63:
+                return None
+            position.append(value)
+        return position
+    except (ValueError, TypeError):
+        return None
+
+def keyset_page(query, columns, cursor, per_page, descending=False, key=None):
+    """One page of query after the cursor position, plus the token for the next page
+
+    Seeks straight to the position with a row-value comparison on the sort
+    columns, so with a matching index every page costs the same as the first.
+    """
+    position = decode_cursor(cursor, columns)
+    if position is not None:
+        if descending:
+            query = query.filter(db.tuple_(*columns) < db.tuple_(*position))
+        else:
+            query = query.filter(db.tuple_(*columns) > db.tuple_(*position))
+
+    ordering = [column.desc() for column in columns] if descending else list(columns)
+    rows = query.order_by(*ordering).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = key(rows[-1]) if key else rows[-1]
+        next_cursor = encode_cursor([getattr(last, column.key) for column in columns])
+    return rows, next_cursor
+
+DECKS_PER_PAGE = 24
+
+# Deck list sort options: (keyset columns, descending)
+DECK_SORTS = {
+    'newest': ((Deck.created_at, Deck.id), True),
+    'oldest': ((Deck.created_at, Deck.id), False),
+    'name': ((Deck.name, Deck.id), False),
+}
+
 @app.route('/')
 @login_required
 def index():
-    decks = Deck.query.filter_by(user_id=current_user.id).all()
-    return render_template('index.html', decks=decks)
+    sort = request.args.get('sort', 'newest')
+    if sort not in DECK_SORTS:
+        sort = 'newest'
+    columns, descending = DECK_SORTS[sort]
+    cursor = request.args.get('cursor')
+
+    decks, next_cursor = keyset_page(with_card_counts(active_decks().filter_by(user_id=current_user.id)),
+                                     columns, cursor, DECKS_PER_PAGE,
+                                     descending=descending, key=lambda row: row[0])
+    return render_template('index.html',
+                         decks=decks,
+                         deleted_decks=undoable_decks(current_user.id).order_by(Deck.deleted_at.desc()).all(),
+                         sort=sort,
+                         cursor=cursor,
+                         next_cursor=next_cursor)
+
+CARDS_PER_PAGE = 50
+MOVE_TARGET_DECKS = 50  # decks listed in the move menu; the rest are reached by name
+
+def deck_card_page(deck_id, cursor):
+    """One page of a deck's cards in the user's order, plus the next page's cursor"""
+    # Cards from before manual ordering get their positions on first view
+    if backfill_positions(deck_id):
+        db.session.commit()
+    return keyset_page(Card.query.filter_by(deck_id=deck_id).options(db.selectinload(Card.tags)),
+                       (Card.position, Card.id), cursor, CARDS_PER_PAGE)
 
 @app.route('/deck/<int:deck_id>')
 @login_required
 def view_deck(deck_id):
-    deck = Deck.query.filter_by(id=deck_id, user_id=current_user.id).first_or_404()
-    return render_template('deck.html', deck=deck)
+    deck, card_count = with_card_counts(
+        active_decks().filter_by(id=deck_id, user_id=current_user.id)
+    ).first_or_404()
+    cursor = request.args.get('cursor')
+    cards, next_cursor = deck_card_page(deck.id, cursor)
+    # One extra row tells us whether to offer the by-name box as well
+    other_decks = active_decks().filter(Deck.user_id == current_user.id, Deck.id != deck.id) \
+        .order_by(Deck.name).limit(MOVE_TARGET_DECKS + 1).all()
+    return render_template('deck.html',
+                         deck=deck,
+                         card_count=card_count,
+                         tags=deck_tags(current_user.id, deck.id),
+                         other_decks=other_decks[:MOVE_TARGET_DECKS],
+                         more_decks=len(other_decks) > MOVE_TARGET_DECKS,
+                         cards=cards,
+                         cursor=cursor,
+                         next_cursor=next_cursor)
+
+@app.route('/api/deck/<int:deck_id>/cards')
+@login_required
+def api_deck_cards(deck_id):
+    """Cursor-paginated JSON feed of a deck's cards"""
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    cards, next_cursor = deck_card_page(deck.id, request.args.get('cursor'))
+    return jsonify({
+        'cards': [card.to_dict() for card in cards],
+        'next_cursor': next_cursor
+    })
+
+# Most cards accepted by one bulk create request
+BULK_CARDS_LIMIT = 1000
+
+def bulk_card_row(deck_id, version, item):
+    """Card row for one item of a bulk create request, or an error message"""
+    if not isinstance(item, dict):
+        return None, 'Each card must be an object.'
+    tags = item.get('tags')
+    if tags is not None and not isinstance(tags, str) and not (
+            isinstance(tags, list) and all(isinstance(tag, str) for tag in tags)):
+        return None, 'Tags must be a comma-separated string or a list of strings.'
+    card_type = item.get('type', 'flashcard')
+    if card_type == 'flashcard':
+        front, back = item.get('front'), item.get('back')
+        if not isinstance(front, str) or not isinstance(back, str) or not front.strip() or not back.strip():
+            return None, 'Flashcards need a non-empty front and back.'
+        return card_row(deck_id, version, 'flashcard', front=front.strip(), back=back.strip()), None
+    if card_type == 'note':
+        content = item.get('content')
+        if not isinstance(content, str) or not content.strip():
+            return None, 'Notes need non-empty content.'
+        return card_row(deck_id, version, 'note', content=content.strip()), None
+    return None, "Card type must be 'flashcard' or 'note'."
+
+@app.route('/api/deck/<int:deck_id>/cards', methods=['POST'])
+@login_required
+def api_create_cards(deck_id):
+    """Create many cards in one transaction; returns their ids in request order
+
+    Takes a JSON array (or {"cards": [...]}) of {"type": "flashcard", "front",
+    "back"} or {"type": "note", "content"} objects, each with optional "tags".
+    Nothing is created unless every card is valid. Cards already in the deck
+    get a null id and are listed under "duplicates".
+    """
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    items = request.get_json(silent=True)
+    if isinstance(items, dict):
+        items = items.get('cards')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Send a JSON array of cards.'}), 400
+    if len(items) > BULK_CARDS_LIMIT:
+        return jsonify({'error': f'Send at most {BULK_CARDS_LIMIT} cards per request.'}), 413
+
+    version = mark_changed(current_user.id, deck)
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        row, error = bulk_card_row(deck.id, version, item)
+        if error:
+            errors.append({'index': index, 'error': error})
+        rows.append(row)
+    if errors:
+        db.session.rollback()
+        return jsonify({'error': 'Some cards are invalid; none were created.', 'cards': errors}), 400
+
+    created = insert_card_rows(current_user.id, rows, batch_size=BULK_CARDS_LIMIT)
+
+    # Tags are linked with one more batched insert once the ids are known
+    tag_names = {}
+    for item, row in zip(items, rows):
+        tags = item.get('tags')
+        if row.get('id') and tags:
+            tag_names[row['id']] = parse_tags(tags if isinstance(tags, str) else ','.join(tags))
+    if tag_names:
+        all_names = sorted({name for names in tag_names.values() for name in names})
+        tags = {tag.name: tag for tag in get_or_create_tags(current_user.id, all_names)}
+        db.session.flush()
+        db.session.execute(card_tags.insert(), [{'card_id': card_id, 'tag_id': tags[name].id}
+                                                for card_id, names in tag_names.items() for name in names])
+    db.session.commit()
+
+    return jsonify({
+        'created': created,
+        'ids': [row.get('id') for row in rows],
+        'duplicates': [index for index, row in enumerate(rows) if not row.get('id')]
+    }), 201
+
+class PrefixIndex:
+    """Sorted array of normalized terms answering prefix queries with bisect"""
+
+    # Terms are also reachable from their first few inner words ('cell' finds 'Animal Cell')
+    MAX_WORD_STARTS = 6
+
+    def __init__(self, entries):
+        keyed = []
+        for text, kind, deck_id in entries:
+            words = normalize_answer(text).split()
+            for start in range(min(len(words), self.MAX_WORD_STARTS)):
+                keyed.append((' '.join(words[start:]), text, kind, deck_id))
+        keyed.sort()
+        self.keys = [entry[0] for entry in keyed]
+        self.entries = keyed
+
+    def complete(self, prefix, limit=8):
+        """Distinct suggestions whose text (or an inner word) starts with prefix"""
+        prefix = normalize_answer(prefix)
+        if not prefix:
+            return []
+
+        suggestions, seen = [], set()
+        position = bisect.bisect_left(self.keys, prefix)
+        while position < len(self.keys) and self.keys[position].startswith(prefix):
+            _, text, kind, deck_id = self.entries[position]
+            if (text, kind) not in seen:
+                seen.add((text, kind))
+                suggestions.append({'text': text, 'kind': kind, 'deck_id': deck_id})
+                if len(suggestions) == limit:
+                    break
+            position += 1
+        return suggestions
+
+# Per-process autocomplete indexes: user id -> (sync version, index); shared by request threads
+_prefix_indexes = OrderedDict()
+_prefix_indexes_lock = threading.Lock()
+PREFIX_CACHE_SIZE = 256
+
+def build_prefix_index(user_id):
+    """Index a user's deck names, card fronts and note keywords"""
+    entries = [(name, 'deck', deck_id) for deck_id, name in
+               db.session.query(Deck.id, Deck.name).filter(Deck.user_id == user_id, Deck.deleted_at.is_(None))]
+
+    # Only notes saved before keywords were stored need their content read
+    legacy_content = db.case((Card.keyword.is_(None), Card.content), else_=None)
+    cards = (db.session.query(Card.card_type, Card.front, Card.keyword, legacy_content, Card.deck_id)
+             .join(Deck).filter(Deck.user_id == user_id, Deck.deleted_at.is_(None)))
+    for card_type, front, keyword, content, deck_id in cards:
+        if card_type == 'flashcard':
+            if front:
+                entries.append((front, 'card', deck_id))
+        else:
+            keyword = keyword or (extract_keyword(content) if content else None)
+            if keyword:
+                entries.append((keyword, 'keyword', deck_id))
+
+    return PrefixIndex(entries)
+
+def get_prefix_index(user):
+    """The user's autocomplete index, rebuilt only after they change something"""
+    with _prefix_indexes_lock:
+        cached = _prefix_indexes.get(user.id)
+        if cached and cached[0] == user.sync_version:
+            _prefix_indexes.move_to_end(user.id)
+            return cached[1]
+
+    # Built outside the lock so one slow user doesn't hold up everyone's lookups
+    index = build_prefix_index(user.id)
+    with _prefix_indexes_lock:
+        _prefix_indexes[user.id] = (user.sync_version, index)
+        _prefix_indexes.move_to_end(user.id)
+        while len(_prefix_indexes) > PREFIX_CACHE_SIZE:
+            _prefix_indexes.popitem(last=False)
+    return index
+
+@app.route('/api/autocomplete')
+@login_required
+def autocomplete():
+    """Search-as-you-type suggestions from the in-process prefix index"""
+    suggestions = get_prefix_index(current_user).complete(request.args.get('q', ''))
+    return jsonify({'suggestions': suggestions})
+
+SEARCH_RESULTS_LIMIT = 50
+
+@app.route('/search')
+@login_required
+def search():
+    query = request.args.get('q', '').strip()
+    results = []
+
+    if query:
+        matches = get_search_backend().search(current_user.id, query, SEARCH_RESULTS_LIMIT)
+        cards = {card.id: card for card in Card.query.filter(Card.id.in_([card_id for card_id, _ in matches]))}
+        decks = {deck.id: deck for deck in active_decks().filter(Deck.id.in_({card.deck_id for card in cards.values()}))}
+        for card_id, snippet in matches:
+            card = cards.get(card_id)
+            if card:
+                results.append({
+                    'card': card,
+                    'deck': decks[card.deck_id],
+                    'snippet': highlight_snippet(snippet)
+                })
+
+    return render_template('search.html', query=query, results=results)
 
 @app.route('/create_deck', methods=['GET', 'POST'])
 @login_required
@@ -204,6 +1495,8 @@ def create_deck():
         description = request.form['description']
 
         deck = Deck(name=name, description=description, user_id=current_user.id)
+        mark_changed(current_user.id, deck)
+        adjust_user_stats(current_user.id, decks=1)
         db.session.add(deck)
         db.session.commit()
 
@@ -215,7 +1508,7 @@ def create_deck():
 @app.route('/deck/<int:deck_id>/add_card', methods=['GET', 'POST'])
 @login_required
 def add_card(deck_id):
-    deck = Deck.query.filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
 
     if request.method == 'POST':
         card_type = request.form['card_type']
@@ -223,44 +1516,783 @@ def add_card(deck_id):
         if card_type == 'flashcard':
             front = request.form['front']
             back = request.form['back']
-            card = Card(front=front, back=back, card_type='flashcard', deck_id=deck_id)
+            content = None
+            card = Card(own_front=front, own_back=back, card_type='flashcard', deck_id=deck_id)
         else:  # note card
+            front = back = None
             content = request.form['content']
-            card = Card(content=content, card_type='note', deck_id=deck_id)
+            card = Card(own_content=content, keyword=note_keyword(content),
+                        card_type='note', deck_id=deck_id)
+        card.content_hash = card_content_hash(card.card_type, front, back, content)
 
+        if find_duplicate(deck_id, card.card_type, card.content_hash):
+            flash('That card is already in this deck, so it was not added again.', 'info')
+            return redirect(url_for('view_deck', deck_id=deck_id))
+
+        card.position = position_between(last_position(deck_id), None)
+        card.tags = get_or_create_tags(current_user.id, parse_tags(request.form.get('tags')))
+
+        similar = None
+        if card.card_type == 'note':
+            similar = find_near_duplicate_note(deck_id, content)
+            adjust_user_stats(current_user.id, notes=1)
+        else:
+            adjust_user_stats(current_user.id, flashcards=1)
+
+        mark_changed(current_user.id, card, deck)
         db.session.add(card)
+        if card.card_type == 'note':
+            db.session.flush()
+            bands = signature_band_rows(card.id, deck_id, content)
+            if bands:
+                db.session.execute(db.insert(CardSignatureBand), bands)
         db.session.commit()
 
-        flash('Card added successfully!', 'success')
+        if similar:
+            flash('Card added, but it looks very similar to a note already in this deck.', 'info')
+        else:
+            flash('Card added successfully!', 'success')
         return redirect(url_for('view_deck', deck_id=deck_id))
 
     return render_template('add_card.html', deck=deck)
 
+@app.route('/card/<int:card_id>/edit', methods=['GET', 'POST'])
+@login_required
+def edit_card(card_id):
+    card = Card.query.get_or_404(card_id)
+    # Verify user owns the deck this card belongs to
+    deck = active_decks().filter_by(id=card.deck_id, user_id=current_user.id).first_or_404()
+
+    if request.method == 'POST':
+        front = back = content = None
+        if card.card_type == 'flashcard':
+            front = request.form.get('front', '').strip()
+            back = request.form.get('back', '').strip()
+            if not front or not back:
+                flash('Flashcards need a front and a back.', 'error')
+                return render_template('edit_card.html', deck=deck, card=card)
+        else:
+            content = request.form.get('content', '').strip()
+            if not content:
+                flash('Notes need some content.', 'error')
+                return render_template('edit_card.html', deck=deck, card=card)
+
+        # Copy on write: clones of this card keep the text they had, and an
+        # edited clone gets text of its own
+        materialize_clones([card.id])
+        card.own_front, card.own_back, card.own_content = front, back, content
+        card.origin_id = None
+        card.keyword = note_keyword(content) if card.card_type == 'note' else None
+        card.content_hash = card_content_hash(card.card_type, front, back, content)
+        mark_changed(current_user.id, card, deck)
+        if card.card_type == 'note':
+            db.session.execute(db.delete(CardSignatureBand).where(CardSignatureBand.card_id == card.id))
+            bands = signature_band_rows(card.id, deck.id, content)
+            if bands:
+                db.session.execute(db.insert(CardSignatureBand), bands)
+        db.session.commit()
+        flash('Card updated!', 'success')
+        return redirect(url_for('view_deck', deck_id=deck.id))
+
+    return render_template('edit_card.html', deck=deck, card=card)
+
+def clone_deck_for(user_id, source, name):
+    """Copy a deck into a user's library without copying its text; returns (deck, cards)
+
+    Each new card points at the card whose text it shares (a clone's own
+    origin, so sharing is always one hop) and only gets text of its own when
+    edited. Cards and their LSH bands are copied with INSERT ... SELECT.
+    Nothing is committed.
+    """
+    backfill_positions(source.id)
+    deck = Deck(name=name, description=source.description, user_id=user_id)
+    db.session.add(deck)
+    version = mark_changed(user_id, deck)
+    db.session.flush()
+
+    now = datetime.utcnow()
+    db.session.execute(db.insert(Card.__table__).from_select(
+        ['deck_id', 'origin_id', 'card_type', 'keyword', 'content_hash', 'position',
+         'version', 'created_at', 'updated_at'],
+        db.select(db.literal(deck.id), db.func.coalesce(Card.origin_id, Card.id), Card.card_type,
+                  Card.keyword, Card.content_hash, Card.position,
+                  db.literal(version), db.literal(now), db.literal(now))
+        .where(Card.deck_id == source.id)
+    ))
+    db.session.execute(db.insert(CardSignatureBand).from_select(
+        ['card_id', 'band', 'deck_id', 'bucket'],
+        db.select(Card.id, CardSignatureBand.band, Card.deck_id, CardSignatureBand.bucket)
+        .join(CardSignatureBand, CardSignatureBand.card_id == Card.origin_id)
+        .where(Card.deck_id == deck.id)
+    ))
+
+    flashcards, notes = deck_card_type_counts(deck.id)
+    adjust_user_stats(user_id, decks=1, flashcards=flashcards, notes=notes)
+    return deck, flashcards + notes
+
+@app.route('/deck/<int:deck_id>/clone', methods=['POST'])
+@login_required
+def clone_deck(deck_id):
+    # Users can clone their own decks and anyone's templates
+    source = active_decks().filter(Deck.id == deck_id, db.or_(Deck.user_id == current_user.id,
+                                                              Deck.is_template)).first_or_404()
+    name = source.name if source.user_id != current_user.id else f'{source.name} (copy)'
+    deck, cards = clone_deck_for(current_user.id, source, name[:100])
+    db.session.commit()
+    flash(f'Cloned {cards} cards into {deck.name}. Cards get their own copy when you edit them.', 'success')
+    return redirect(url_for('view_deck', deck_id=deck.id))
+
+@app.route('/deck/<int:deck_id>/template', methods=['POST'])
+@login_required
+def toggle_template(deck_id):
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    deck.is_template = not deck.is_template
+    db.session.commit()
+    if deck.is_template:
+        flash('Deck shared as a template. Anyone can now clone it.', 'success')
+    else:
+        flash('Deck is no longer shared as a template.', 'info')
+    return redirect(url_for('view_deck', deck_id=deck.id))
+
+@app.route('/templates')
+@login_required
+def deck_templates():
+    cursor = request.args.get('cursor')
+    decks, next_cursor = keyset_page(with_card_counts(active_decks().filter(Deck.is_template)),
+                                     (Deck.name, Deck.id), cursor, DECKS_PER_PAGE,
+                                     key=lambda row: row[0])
+    return render_template('templates.html', decks=decks, cursor=cursor, next_cursor=next_cursor)
+
+# A sentence runs to its closing punctuation or the end of the line
+SENTENCE_PATTERN = re.compile(r'[^.!?\n]+[.!?]*')
+
+def iter_sentences(text):
+    """Yield the sentences of a note one at a time"""
+    for match in SENTENCE_PATTERN.finditer(text):
+        sentence = match.group().strip()
+        if sentence:
+            yield sentence
+
+def iter_cloze_cards(text):
+    """Yield (front, back) pairs: each sentence with its key term blanked out"""
+    for sentence in iter_sentences(text):
+        if len(sentence.split()) < 4:
+            continue
+        keyword = extract_keyword(sentence)
+        pattern = re.compile(r'\b' + re.escape(keyword) + r'\b', re.IGNORECASE)
+        front, blanks = pattern.subn('_____', sentence)
+        if blanks:
+            yield front, keyword
+
+@app.route('/card/<int:card_id>/cloze', methods=['POST'])
+@login_required
+def generate_cloze_cards(card_id):
+    card = Card.query.get_or_404(card_id)
+    deck = active_decks().filter_by(id=card.deck_id, user_id=current_user.id).first_or_404()
+    if card.card_type != 'note':
+        flash('Cloze cards can only be made from note cards.', 'error')
+        return redirect(url_for('view_deck', deck_id=deck.id))
+
+    version = mark_changed(current_user.id, deck)
+    rows = (card_row(deck.id, version, 'flashcard', front=front, back=back)
+            for front, back in iter_cloze_cards(card.content))
+    created = insert_card_rows(current_user.id, rows)
+    db.session.commit()
+
+    if created:
+        flash(f'Generated {created} cloze cards from your note!', 'success')
+    else:
+        flash('No sentences in this note were long enough to make cloze cards.', 'info')
+    return redirect(url_for('view_deck', deck_id=deck.id))
+
+# Imported rows per insert statement, and how many bad rows are listed back
+IMPORT_BATCH = 5000
+IMPORT_MAX_ERRORS = 50
+IMPORT_DELIMITERS = {'comma': ',', 'tab': '\t', 'semicolon': ';'}
+# Header rows that are skipped rather than imported as a card
+IMPORT_HEADERS = {('front', 'back'), ('term', 'definition'), ('question', 'answer'), ('content',), ('note',)}
+
+def guess_delimiter(line):
+    """Tab, semicolon or comma, whichever the first line uses"""
+    for delimiter in ('\t', ';'):
+        if delimiter in line:
+            return delimiter
+    return ','
+
+def iter_import_rows(lines, deck_id, version, errors, delimiter=None):
+    """Turn CSV/TSV lines into card rows, noting bad rows in errors instead of stopping
+
+    Two columns make a flashcard (front, back); one column makes a note.
+    errors collects (line number, message) pairs.
+    """
+    lines = iter(lines)
+    first = next(lines, '')
+    reader = csv.reader(itertools.chain([first], lines), delimiter=delimiter or guess_delimiter(first))
+
+    while True:
+        try:
+            cells = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            errors.append((reader.line_num, str(e)))
+            continue
+
+        cells = [cell.strip() for cell in cells]
+        if not any(cells):
+            continue
+        # Spreadsheets often pad rows with empty trailing columns
+        while len(cells) > 2 and not cells[-1]:
+            cells.pop()
+        if reader.line_num == 1 and tuple(cell.lower() for cell in cells) in IMPORT_HEADERS:
+            continue
+
+        if len(cells) == 1:
+            yield card_row(deck_id, version, 'note', content=cells[0])
+        elif len(cells) == 2 and all(cells):
+            yield card_row(deck_id, version, 'flashcard', front=cells[0], back=cells[1])
+        elif len(cells) == 2:
+            errors.append((reader.line_num, 'Flashcards need both a front and a back.'))
+        else:
+            errors.append((reader.line_num, f'Expected 1 or 2 columns, found {len(cells)}.'))
+
+@app.route('/deck/<int:deck_id>/import', methods=['GET', 'POST'])
+@login_required
+def import_cards(deck_id):
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    if request.method == 'GET':
+        return render_template('import_cards.html', deck=deck)
+
+    upload = request.files.get('cards_file')
+    if upload and upload.filename:
+        # Decode the upload line by line instead of reading it whole
+        lines = codecs.iterdecode(upload.stream, 'utf-8-sig')
+    else:
+        lines = request.form.get('pasted', '').splitlines(keepends=True)
+    delimiter = IMPORT_DELIMITERS.get(request.form.get('delimiter'))
+
+    errors = []
+    rows_seen = 0
+
+    def counted(rows):
+        nonlocal rows_seen
+        for row in rows:
+            rows_seen += 1
+            yield row
+
+    version = mark_changed(current_user.id, deck)
+    try:
+        created = insert_card_rows(current_user.id,
+                                   counted(iter_import_rows(lines, deck.id, version, errors, delimiter)),
+                                   batch_size=IMPORT_BATCH)
+    except UnicodeDecodeError:
+        db.session.rollback()
+        flash('Please save the file as UTF-8 text and try again.', 'error')
+        return render_template('import_cards.html', deck=deck)
+    db.session.commit()
+
+    if created:
+        flash(f'Imported {created} cards into {deck.name}!', 'success')
+    elif not errors:
+        flash('No cards found to import.', 'info')
+    return render_template('import_cards.html',
+                         deck=deck,
+                         imported=created,
+                         duplicates=rows_seen - created,
+                         errors=errors[:IMPORT_MAX_ERRORS],
+                         error_count=len(errors))
+
+# Anki packages: a zip holding the collection database (newest schema first)
+ANKI_COLLECTIONS = ('collection.anki21', 'collection.anki2')
+ANKI_FIELD_SEPARATOR = '\x1f'
+ANKI_CLOZE_MODEL = 1
+ANKI_CLOZE_PATTERN = re.compile(r'\{\{c(\d+)::(.*?)(?:::(.*?))?\}\}', re.DOTALL)
+ANKI_BREAK_PATTERN = re.compile(r'<br\s*/?>|</?(?:div|p|li)\b[^>]*>', re.IGNORECASE)
+ANKI_MARKUP_PATTERN = re.compile(r'<[^>]*>|\[sound:[^\]]*\]')
+
+def strip_anki_html(text):
+    """Plain text of an Anki field: markup and sounds dropped, entities decoded"""
+    text = ANKI_MARKUP_PATTERN.sub('', ANKI_BREAK_PATTERN.sub('\n', text))
+    lines = (' '.join(line.split()) for line in html.unescape(text).splitlines())
+    return '\n'.join(line for line in lines if line)
+
+def iter_anki_cloze(text):
+    """Yield (front, back) for each cloze number in an Anki cloze field"""
+    numbers = sorted({int(match.group(1)) for match in ANKI_CLOZE_PATTERN.finditer(text)})
+    for number in numbers:
+        answers = []
+
+        def blank(match):
+            if int(match.group(1)) != number:
+                return match.group(2)
+            answers.append(match.group(2))
+            return f'[{match.group(3)}]' if match.group(3) else '_____'
+
+        front = ANKI_CLOZE_PATTERN.sub(blank, text)
+        yield strip_anki_html(front), strip_anki_html(', '.join(answers))
+
+def extract_anki_collection(archive, target):
+    """Copy the collection database out of an .apkg zip into the open file target"""
+    with zipfile.ZipFile(archive) as package:
+        names = set(package.namelist())
+        if ANKI_COLLECTIONS[0] not in names and 'collection.anki21b' in names:
+            # Newer exports compress the real collection with zstd; the plain
+            # collection.anki2 beside it only holds an "update Anki" note
+            raise ValueError('Export the deck from Anki with "Support older Anki versions" ticked.')
+        for name in ANKI_COLLECTIONS:
+            if name in names:
+                with package.open(name) as source:
+                    shutil.copyfileobj(source, target)
+                return
+    raise ValueError('That package has no Anki collection in it.')
+
+def iter_anki_notes(collection_path):
+    """Yield (fields, is_cloze) for each note of an Anki collection, opened read-only"""
+    uri = pathlib.Path(collection_path).resolve().as_uri() + '?mode=ro&immutable=1'
+    connection = sqlite3.connect(uri, uri=True)
+    try:
+        try:
+            models = json.loads(connection.execute('SELECT models FROM col').fetchone()[0] or '{}')
+        except (sqlite3.Error, TypeError, ValueError):
+            models = {}  # newer schemas keep note types in their own table
+        cloze_models = {int(model_id) for model_id, model in models.items()
+                        if model.get('type') == ANKI_CLOZE_MODEL}
+
+        for model_id, fields in connection.execute('SELECT mid, flds FROM notes ORDER BY id'):
+            fields = fields.split(ANKI_FIELD_SEPARATOR)
+            yield fields, model_id in cloze_models or bool(ANKI_CLOZE_PATTERN.search(fields[0]))
+    finally:
+        connection.close()
+
+def iter_anki_rows(collection_path, deck_id, version):
+    """Card rows for an Anki collection: one flashcard per basic note or cloze number"""
+    for fields, is_cloze in iter_anki_notes(collection_path):
+        if is_cloze:
+            for front, back in iter_anki_cloze(fields[0]):
+                if front and back:
+                    yield card_row(deck_id, version, 'flashcard', front=front, back=back)
+            continue
+
+        front = strip_anki_html(fields[0])
+        back = strip_anki_html(fields[1]) if len(fields) > 1 else ''
+        if front and back:
+            yield card_row(deck_id, version, 'flashcard', front=front, back=back)
+        elif front or back:
+            yield card_row(deck_id, version, 'note', content=front or back)
+
+def import_anki_package(user_id, archive, name, progress=None):
+    """Create a deck from an .apkg file and bulk insert its notes
+
+    Nothing is committed. Returns (deck, cards imported).
+    """
+    deck = Deck(name=name[:100], description='Imported from Anki', user_id=user_id)
+    with tempfile.TemporaryDirectory() as workdir:
+        # SQLite needs a real file, so the collection is streamed out of the zip first
+        collection_path = os.path.join(workdir, 'collection.anki2')
+        with open(collection_path, 'wb') as target:
+            extract_anki_collection(archive, target)
+
+        version = mark_changed(user_id, deck)
+        db.session.add(deck)
+        adjust_user_stats(user_id, decks=1)
+        db.session.flush()
+        created = insert_card_rows(user_id, iter_anki_rows(collection_path, deck.id, version),
+                                   batch_size=IMPORT_BATCH, progress=progress)
+    return deck, created
+
+@app.route('/import_anki', methods=['GET', 'POST'])
+@login_required
+def import_anki():
+    if request.method == 'GET':
+        return render_template('import_anki.html')
+
+    package = request.files.get('package')
+    if not package or not package.filename:
+        flash('Choose an Anki .apkg file to import.', 'error')
+        return render_template('import_anki.html')
+    name = request.form.get('name', '').strip() or os.path.splitext(package.filename)[0]
+
+    job = enqueue_job('import-anki', current_user.id, upload=package, name=name)
+    return redirect(url_for('view_job', job_id=job.id))
+
 @app.route('/deck/<int:deck_id>/study')
 @login_required
 def study_deck(deck_id):
-    deck = Deck.query.filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    tags = parse_tags(','.join(request.args.getlist('tag')))
+    cards = filter_by_tags(Card.query.filter_by(deck_id=deck.id), current_user.id, tags)
+    cards = cards.order_by(Card.position, Card.id)
 
     # Prepare cards for study mode
-    study_cards = []
+    study_cards = [card.to_study_dict() for card in cards]
+
+    return render_template('study.html', deck=deck, study_cards=study_cards, tags=tags)
+
+@app.route('/card/<int:card_id>/tags', methods=['POST'])
+@login_required
+def update_card_tags(card_id):
+    card = Card.query.get_or_404(card_id)
+    deck = active_decks().filter_by(id=card.deck_id, user_id=current_user.id).first_or_404()
+    card.tags = get_or_create_tags(current_user.id, parse_tags(request.form.get('tags')))
+    db.session.commit()
+    flash('Tags updated!', 'success')
+    return redirect(request.referrer or url_for('view_deck', deck_id=deck.id))
+
+@app.route('/card/<int:card_id>/move', methods=['POST'])
+@login_required
+def move_card(card_id):
+    """Reorder a card by giving it a new position key; no other card is rewritten"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = request.form
+    after_id = data.get('after_id')
+    if after_id is not None:
+        try:
+            after_id = int(after_id)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'after_id must be a card id.'}), 400
+
+    card = Card.query.get_or_404(card_id)
+    deck = active_decks().filter_by(id=card.deck_id, user_id=current_user.id).first_or_404()
+    lock_deck(deck.id)
+    # Another move may have committed between reading the card and taking the lock
+    db.session.refresh(card)
+    backfill_positions(deck.id)
+    untie_positions(deck.id, card.position)
+    siblings = Card.query.filter(Card.deck_id == deck.id, Card.id != card.id)
+    later = siblings.order_by(Card.position)
+    earlier = siblings.order_by(Card.position.desc())
+
+    if after_id is not None:
+        # Drop the card straight after another one (0 moves it to the top)
+        after = siblings.filter_by(id=after_id).first_or_404() if after_id else None
+        if after:
+            untie_positions(deck.id, after.position)
+        following = later.filter(Card.position > after.position).first() if after else later.first()
+        position = position_between(after.position if after else None,
+                                    following.position if following else None)
+    elif data.get('direction') == 'up':
+        above = earlier.filter(Card.position < card.position).limit(2).all()
+        if len(above) > 1 and above[0].position == above[1].position:
+            untie_positions(deck.id, above[0].position)
+            above = earlier.filter(Card.position < card.position).limit(2).all()
+        position = position_between(above[1].position if len(above) > 1 else None,
+                                    above[0].position) if above else card.position
+    elif data.get('direction') == 'down':
+        below = later.filter(Card.position > card.position).limit(2).all()
+        if len(below) > 1 and below[0].position == below[1].position:
+            untie_positions(deck.id, below[0].position)
+            below = later.filter(Card.position > card.position).limit(2).all()
+        position = position_between(below[0].position,
+                                    below[1].position if len(below) > 1 else None) if below else card.position
+    else:
+        position = card.position
+
+    if position != card.position:
+        card.position = position
+        mark_changed(current_user.id, card)
+    db.session.commit()
+
+    if request.is_json:
+        return jsonify({'id': card.id, 'position': card.position})
+    return redirect(request.referrer or url_for('view_deck', deck_id=deck.id))
+
+# Rows fetched per round trip from each deck's cursor in a multi-deck session
+STUDY_STREAM_BATCH = 100
+
+def iter_study_cards(deck_ids, newest_first=False):
+    """Merge the per-deck card streams into one stream ordered by creation time"""
+    if newest_first:
+        ordering = (Card.created_at.desc(), Card.id.desc())
+    else:
+        ordering = (Card.created_at, Card.id)
+
+    # Each deck is read in index order through its own cursor; the heap only
+    # ever holds one pending card per deck
+    streams = [
+        Card.query.filter_by(deck_id=deck_id).order_by(*ordering).yield_per(STUDY_STREAM_BATCH)
+        for deck_id in deck_ids
+    ]
+    return heapq.merge(*streams, key=lambda card: (card.created_at, card.id), reverse=newest_first)
+
+def selected_study_decks():
+    """Decks picked for a multi-deck session (all decks when none are given)"""
+    query = active_decks().filter_by(user_id=current_user.id)
+    deck_ids = request.args.getlist('deck', type=int)
+    if deck_ids:
+        query = query.filter(Deck.id.in_(deck_ids))
+    return query.order_by(Deck.name).all()
+
+@app.route('/study')
+@login_required
+def study_session():
+    all_decks = active_decks().filter_by(user_id=current_user.id).order_by(Deck.name).all()
+    decks = selected_study_decks()
+    order = request.args.get('order', 'created')
+
+    total_cards = 0
+    if decks:
+        total_cards = Card.query.filter(Card.deck_id.in_([deck.id for deck in decks])).count()
+
+    return render_template('study_session.html',
+                         all_decks=all_decks,
+                         decks=decks,
+                         order=order,
+                         total_cards=total_cards)
+
+@app.route('/api/study/stream')
+@login_required
+def study_stream():
+    """Stream an interleaved multi-deck session as newline-delimited JSON"""
+    decks = selected_study_decks()
+    deck_names = {deck.id: deck.name for deck in decks}
+    newest_first = request.args.get('order') == 'newest'
+
+    def generate():
+        for card in iter_study_cards(list(deck_names), newest_first=newest_first):
+            study_card = card.to_study_dict()
+            study_card['deck'] = deck_names[card.deck_id]
+            yield json.dumps(study_card) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def normalize_answer(text):
+    """Lowercase, drop accents and punctuation, and collapse whitespace"""
+    text = text or ''
+    if not text.isascii():  # ASCII has no accents to strip
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+    return ' '.join(text.split())
+
+def answer_tolerance(expected):
+    """Number of typos accepted for a normalized expected answer"""
+    return len(expected) // 5
+
+def bounded_edit_distance(a, b, limit):
+    """Levenshtein distance between a and b, or None if it exceeds limit
+
+    Uses the bit-parallel Myers/Hyyrö algorithm: each column of the DP matrix
+    is packed into an integer, so the cost is one pass over b no matter how
+    long a is. Gives up as soon as the remaining characters of b can no
+    longer bring the distance back under the limit.
+    """
+    m, n = len(a), len(b)
+    if abs(m - n) > limit:
+        return None
+    if m == 0:
+        return n
+
+    # Bitmask of the positions of each character in a
+    peq = {}
+    for i, char in enumerate(a):
+        peq[char] = peq.get(char, 0) | (1 << i)
+
+    mask = (1 << m) - 1
+    high_bit = 1 << (m - 1)
+    pv, mv = mask, 0
+    score = m
+
+    for j, char in enumerate(b, 1):
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+
+        if ph & high_bit:
+            score += 1
+        elif mh & high_bit:
+            score -= 1
+
+        # Each remaining character can lower the score by at most one
+        if score - (n - j) > limit:
+            return None
+
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+
+    return score if score <= limit else None
+
+def grade_answer(given, expected):
+    """Compare a typed answer with the expected one, tolerating small typos"""
+    given = normalize_answer(given)
+    expected = normalize_answer(expected)
+    allowed = answer_tolerance(expected)
+    distance = bounded_edit_distance(given, expected, allowed)
+    return {
+        'correct': distance is not None,
+        'distance': distance,
+        'allowed': allowed
+    }
+
+@app.route('/deck/<int:deck_id>/type')
+@login_required
+def type_answers(deck_id):
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+
+    # Answers stay on the server; the page only gets prompts
+    prompts = []
     for card in deck.cards:
-        if card.card_type == 'flashcard':
-            study_cards.append({
-                'front': card.front,
-                'back': card.back,
-                'type': 'flashcard'
-            })
-        else:  # note card
-            keyword = card.extract_keyword()
-            study_cards.append({
-                'front': keyword,
-                'back': card.content,
-                'type': 'note'
-            })
+        prompt, expected = card.answer_prompt()
+        if prompt and expected:
+            prompts.append({'id': card.id, 'prompt': prompt, 'type': card.card_type})
 
-    return render_template('study.html', deck=deck, study_cards=study_cards)
+    return render_template('study_type.html', deck=deck, prompts=prompts)
 
-import random
+@app.route('/api/card/<int:card_id>/grade', methods=['POST'])
+@login_required
+def grade_card(card_id):
+    card = Card.query.join(Deck).filter(Card.id == card_id, Deck.user_id == current_user.id,
+                                        Deck.deleted_at.is_(None)).first_or_404()
+    payload = request.get_json(silent=True) or {}
+    answer = payload.get('answer', '') if isinstance(payload, dict) else None
+    if not isinstance(answer, str):
+        return jsonify({'error': 'Send the answer as a string.'}), 400
+    prompt, expected = card.answer_prompt()
+
+    result = grade_answer(answer, expected or '')
+    # Live (per keystroke) checks must not give the answer away
+    if payload.get('final'):
+        result['expected'] = expected
+        record_study_result(current_user.id, card.deck_id, card.id, result['correct'])
+        db.session.commit()
+    return jsonify(result)
+
+@app.route('/api/study/record', methods=['POST'])
+@login_required
+def record_study():
+    """Record a self-graded or quiz answer for the activity heatmap and retention curves"""
+    payload = request.get_json(silent=True) or {}
+    card = Card.query.join(Deck).filter(Card.id == payload.get('card_id'), Deck.user_id == current_user.id,
+                                        Deck.deleted_at.is_(None)).first_or_404()
+    record_study_result(current_user.id, card.deck_id, card.id, bool(payload.get('correct')))
+    db.session.commit()
+    return jsonify({'recorded': True})
+
+class DistractorIndex:
+    """Character n-gram index over a deck's answers, bucketed by length"""
+
+    NGRAM = 3
+    # Grams shared by this many answers say little about similarity
+    MAX_POSTING = 500
+
+    def __init__(self, answers):
+        self.answers = {}
+        self.normalized = {}
+        self.postings = {}
+
+        for card_id, answer in answers:
+            normalized = normalize_answer(answer)
+            if not normalized:
+                continue
+            self.answers[card_id] = answer
+            self.normalized[card_id] = normalized
+            bucket = self.length_bucket(normalized)
+            for gram in self.ngrams(normalized):
+                self.postings.setdefault((bucket, gram), []).append(card_id)
+
+    @classmethod
+    def ngrams(cls, text):
+        """Distinct character n-grams of a normalized answer"""
+        padded = f' {text} '
+        return {padded[i:i + cls.NGRAM] for i in range(max(1, len(padded) - cls.NGRAM + 1))}
+
+    @staticmethod
+    def length_bucket(text):
+        """Logarithmic length bucket, so 'similar length' scales with the answer"""
+        return round(math.log2(len(text) + 1) * 2)
+
+    def distractors(self, card_id, count=3):
+        """Answers from other cards that look most like this card's answer"""
+        target = self.normalized.get(card_id)
+        if target is None:
+            return []
+
+        bucket = self.length_bucket(target)
+        shared = Counter()
+        for gram in self.ngrams(target):
+            for nearby in (bucket - 1, bucket, bucket + 1):
+                posting = self.postings.get((nearby, gram), ())
+                if len(posting) <= self.MAX_POSTING:
+                    shared.update(posting)
+
+        picked, seen = [], {target}
+        for other_id, _ in shared.most_common():
+            if len(picked) == count:
+                break
+            if self.normalized[other_id] not in seen:
+                seen.add(self.normalized[other_id])
+                picked.append(self.answers[other_id])
+
+        # Small or very uniform decks: top up with any other answers
+        if len(picked) < count:
+            others = [cid for cid in self.answers if self.normalized[cid] not in seen]
+            for other_id in random.sample(others, len(others)):
+                if len(picked) == count:
+                    break
+                if self.normalized[other_id] not in seen:
+                    seen.add(self.normalized[other_id])
+                    picked.append(self.answers[other_id])
+
+        return picked
+
+# Per-process cache of distractor indexes: deck id -> (deck version, index); shared by request threads
+_distractor_indexes = OrderedDict()
+_distractor_indexes_lock = threading.Lock()
+DISTRACTOR_CACHE_SIZE = 64
+
+def get_distractor_index(deck):
+    """Distractor index for a deck, rebuilt only when the deck's version moves"""
+    with _distractor_indexes_lock:
+        cached = _distractor_indexes.get(deck.id)
+        if cached and cached[0] == deck.version:
+            _distractor_indexes.move_to_end(deck.id)
+            return cached[1]
+
+    answers = []
+    for card in Card.query.filter_by(deck_id=deck.id):
+        prompt, expected = card.answer_prompt()
+        if prompt and expected:
+            answers.append((card.id, expected))
+
+    index = DistractorIndex(answers)
+    with _distractor_indexes_lock:
+        _distractor_indexes[deck.id] = (deck.version, index)
+        _distractor_indexes.move_to_end(deck.id)
+        while len(_distractor_indexes) > DISTRACTOR_CACHE_SIZE:
+            _distractor_indexes.popitem(last=False)
+    return index
+
+@app.route('/deck/<int:deck_id>/quiz')
+@login_required
+def quiz_deck(deck_id):
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    count = max(1, min(request.args.get('count', 10, type=int), 50))
+
+    index = get_distractor_index(deck)
+    card_ids = random.sample(list(index.answers), min(count, len(index.answers)))
+    cards = Card.query.filter(Card.id.in_(card_ids)).all() if card_ids else []
+
+    questions = []
+    for card in cards:
+        prompt, answer = card.answer_prompt()
+        options = index.distractors(card.id) + [answer]
+        if len(options) < 2:
+            continue
+        random.shuffle(options)
+        questions.append({
+            'card_id': card.id,
+            'prompt': prompt,
+            'type': card.card_type,
+            'options': options,
+            'answer': options.index(answer)
+        })
+    random.shuffle(questions)
+
+    return render_template('quiz.html', deck=deck, questions=questions)
 
 class CrosswordGenerator:
     def __init__(self, size=15):
@@ -398,13 +2430,16 @@ class CrosswordGenerator:
 @app.route('/deck/<int:deck_id>/crossword')
 @login_required
 def generate_crossword(deck_id):
-    deck = Deck.query.filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    tags = parse_tags(','.join(request.args.getlist('tag')))
+    cards = filter_by_tags(Card.query.filter_by(deck_id=deck.id), current_user.id, tags)
+    cards = cards.order_by(Card.position, Card.id)
 
     # Collect words and clues from deck
     word_clue_pairs = []
 
     # Add flashcards
-    for card in deck.cards:
+    for card in cards:
         if card.card_type == 'flashcard':
             # Use front as clue, back as answer
             answer = card.back.strip()
@@ -504,6 +2539,8 @@ def register():
         user = User(username=username)
         user.set_password(password)
         db.session.add(user)
+        db.session.flush()
+        db.session.add(UserStats(user_id=user.id))
         db.session.commit()
 
         flash('Registration successful! Please log in.', 'success')
@@ -540,77 +2577,1117 @@ def logout():
 @app.route('/profile')
 @login_required
 def profile():
-    total_decks = Deck.query.filter_by(user_id=current_user.id).count()
-    total_cards = db.session.query(Card).join(Deck).filter(Deck.user_id == current_user.id).count()
+    stats = db.session.get(UserStats, current_user.id)
+    if stats is None:
+        # Accounts created before stats were tracked get their row on first visit
+        rebuild_user_stats([current_user.id])
+        db.session.commit()
+        stats = db.session.get(UserStats, current_user.id)
 
+    today = datetime.utcnow().date()
     return render_template('profile.html',
                          user=current_user,
-                         total_decks=total_decks,
-                         total_cards=total_cards)
+                         stats=stats,
+                         heatmap=study_heatmap(current_user.id, today),
+                         retention=deck_retention(current_user.id, today))
+
+# Rows per round trip while streaming a backup, and bytes per response chunk
+EXPORT_BATCH = 500
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def iter_export_json(user_id, username, version, since=None):
+    """Yield the backup document piece by piece, one card at a time
+
+    With since, only decks and cards changed after that sync version are
+    written (a deck is included when any of its cards changed), followed by
+    the ids deleted since then, so the file can be applied to a full backup.
+    """
+    cards_join = Card.deck_id == Deck.id
+    if since is not None:
+        cards_join = db.and_(cards_join, Card.version > since)
+    query = (db.select(Deck.id, Deck.name, Deck.description, Deck.created_at,
+                       Card.id.label('card_id'), Card.card_type, Card.front, Card.back,
+                       Card.content, Card.position, Card.created_at.label('card_created_at'))
+             .outerjoin(Card, cards_join)
+             .where(Deck.user_id == user_id, Deck.deleted_at.is_(None)))
+    if since is not None:
+        query = query.where(db.or_(Deck.version > since, Card.id.isnot(None)))
+
+    # A single statement reads every row from the same snapshot; yield_per
+    # streams it through a server-side cursor where the driver has one
+    rows = db.session.execute(query.order_by(Deck.id, Card.position, Card.id)
+                              .execution_options(yield_per=EXPORT_BATCH))
+
+    header = {
+        'user': username,
+        'export_date': datetime.utcnow().isoformat(),
+        'type': 'full' if since is None else 'incremental',
+        'version': version
+    }
+    if since is not None:
+        header['since'] = since
+    # Leave the object open so the decks can follow
+    yield json.dumps(header)[:-1] + ', "decks": ['
+
+    deck_id = None
+    first_card = True
+    for row in rows:
+        if row.id != deck_id:
+            if deck_id is not None:
+                yield ']}, '
+            deck_id = row.id
+            first_card = True
+            deck_data = {
+                'id': row.id,
+                'name': row.name,
+                'description': row.description,
+                'created_at': row.created_at.isoformat()
+            }
+            yield json.dumps(deck_data)[:-1] + ', "cards": ['
+
+        if row.card_id is None:  # deck without (changed) cards
+            continue
+
+        card_data = {
+            'id': row.card_id,
+            'type': row.card_type,
+            'position': row.position,
+            'created_at': row.card_created_at.isoformat()
+        }
+        if row.card_type == 'flashcard':
+            card_data['front'] = row.front
+            card_data['back'] = row.back
+        else:
+            card_data['content'] = row.content
+
+        yield ('' if first_card else ', ') + json.dumps(card_data)
+        first_card = False
+
+    if deck_id is not None:
+        yield ']}'
+    if since is None:
+        yield ']}'
+        return
+
+    tombstones = db.session.query(Tombstone.object_type, Tombstone.object_id).filter(
+        Tombstone.user_id == user_id, Tombstone.version > since).order_by(Tombstone.version)
+    deleted = {'decks': [], 'cards': []}
+    for object_type, object_id in tombstones:
+        deleted[object_type + 's'].append(object_id)
+    yield '], "deleted": %s}' % json.dumps(deleted)
+
+def iter_chunks(pieces, compress=False, size=EXPORT_CHUNK_SIZE):
+    """Join small text pieces into byte chunks of about size, gzipping them on the fly"""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # 31: gzip container
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= size:
+            chunk = b''.join(buffer)
+            buffer = []
+            buffered = 0
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+
+    chunk = b''.join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+def advance_export_watermark(user_id, version):
+    """Record that a backup covering changes up to version was sent in full"""
+    db.session.execute(
+        db.update(User)
+        .where(User.id == user_id, User.export_watermark < version)
+        .values(export_watermark=version)
+    )
+    db.session.commit()
 
 @app.route('/export_data')
 @login_required
 def export_data():
-    import json
+    """Stream a JSON backup, optionally gzipped and/or only the changes since the last one"""
+    compress = request.args.get('gzip', type=int) == 1
+    since = None
+    if request.args.get('incremental', type=int) == 1:
+        since = request.args.get('since', current_user.export_watermark, type=int)
+
+    user_id, username = current_user.id, current_user.username
+    version = current_user.sync_version
+
+    filename = f'naturecards_backup_{username}'
+    if since is not None:
+        filename += f'_changes_{since}_{version}'
+    filename += '.json' + ('.gz' if compress else '')
+    pieces = iter_export_json(user_id, username, version, since=since)
+
+    def stream():
+        yield from iter_chunks(pieces, compress=compress)
+        # Remember where this backup ends, so the next incremental one starts
+        # there; only once the last byte is out, so an interrupted download
+        # leaves its changes to the next one
+        advance_export_watermark(user_id, version)
+
+    response = Response(stream_with_context(stream()),
+                        mimetype='application/gzip' if compress else 'application/json')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
 
-    # Get all user's decks and cards
-    decks = Deck.query.filter_by(user_id=current_user.id).all()
+# Characters read from a backup file per refill of the parse buffer
+BACKUP_READ_SIZE = 256 * 1024
+
+class BackupReader:
+    """Pull parser for backup files that hands out one deck at a time
+
+    Only the top-level object is walked by hand; each deck is decoded with
+    the C JSON decoder once enough of the file is buffered, so memory is
+    bounded by the largest deck rather than the whole document.
+    """
+
+    def __init__(self, stream, read_size=BACKUP_READ_SIZE):
+        self.stream = stream
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buffer = ''
+        self.pos = 0
+        self.header = {}
+
+    def _fill(self, size=None):
+        """Append more of the file to the buffer, dropping what was consumed"""
+        chunk = self.stream.read(size or self.read_size)
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk, final=not chunk)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
 
-    export_data = {
-        'user': current_user.username,
-        'export_date': datetime.utcnow().isoformat(),
-        'decks': []
-    }
+    def _peek(self):
+        """Next non-whitespace character, or '' at the end of the file"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError(f'Malformed backup: expected {chars!r}, found {char!r}')
+        self.pos += 1
+        return char
+
+    def _value(self):
+        """Decode the next JSON value, reading ahead until it is complete"""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Double the read-ahead so a large deck is re-scanned only a few times
+                if not self._fill(max(self.read_size, len(self.buffer) - self.pos)):
+                    raise
+                continue
+            # A number could carry on in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def decks(self):
+        """Yield each deck dict in file order; other top-level keys land in header"""
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'decks':
+                self._expect('[')
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.header[key] = self._value()
+            if self._expect(',}') == '}':
+                return
 
-    for deck in decks:
-        deck_data = {
-            'name': deck.name,
-            'description': deck.description,
-            'created_at': deck.created_at.isoformat(),
-            'cards': []
-        }
+def open_backup(raw):
+    """Binary stream of a backup, transparently gunzipped"""
+    magic = raw.read(2)
+    raw.seek(0)
+    return gzip.GzipFile(fileobj=raw) if magic == b'\x1f\x8b' else raw
 
-        for card in deck.cards:
-            card_data = {
-                'type': card.card_type,
-                'created_at': card.created_at.isoformat()
-            }
+def parse_backup_datetime(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+def restore_backup(user_id, stream, progress=None):
+    """Add the decks and cards of a backup file to a user's library
+
+    Decks are matched by name, so cards restored into an existing deck go
+    through the usual duplicate check and restoring twice adds nothing new.
+    Nothing is committed; progress(decks, cards) is called after each deck.
+    Returns (decks, cards) restored.
+    """
+    restored_decks = restored_cards = 0
+    now = datetime.utcnow()
+
+    reader = BackupReader(open_backup(stream))
+    for deck_data in reader.decks():
+        if reader.header.get('type') == 'incremental':
+            raise ValueError('Incremental backups must be merged into a full backup before restoring.')
+        if not isinstance(deck_data, dict) or not isinstance(deck_data.get('cards') or [], list):
+            raise ValueError('Malformed backup: each deck must be an object with a list of cards.')
+        if not all(isinstance(deck_data.get(key) or '', str) for key in ('name', 'description')):
+            raise ValueError('Malformed backup: deck names and descriptions must be text.')
+        name = (deck_data.get('name') or 'Restored Deck')[:100]
+        deck = active_decks().filter_by(user_id=user_id, name=name).first()
+        if deck is None:
+            deck = Deck(name=name, description=deck_data.get('description') or '', user_id=user_id,
+                        created_at=parse_backup_datetime(deck_data.get('created_at')) or now)
+            db.session.add(deck)
+            adjust_user_stats(user_id, decks=1)
+        version = mark_changed(user_id, deck)
+        db.session.flush()
+
+        rows = []
+        for card_data in deck_data.get('cards') or []:
+            if not isinstance(card_data, dict):
+                raise ValueError(f'Malformed backup: a card in "{name}" is not an object.')
+            card_type = card_data.get('type')
+            if card_type not in ('flashcard', 'note'):
+                continue
+            if not all(isinstance(card_data.get(key) or '', str) for key in ('front', 'back', 'content')):
+                raise ValueError(f'Malformed backup: card text in "{name}" must be strings.')
+            row = card_row(deck.id, version, card_type, card_data.get('front'),
+                           card_data.get('back'), card_data.get('content'))
+            row['created_at'] = parse_backup_datetime(card_data.get('created_at')) or now
+            rows.append(row)
+
+        restored_cards += insert_card_rows(user_id, rows)
+        restored_decks += 1
+        if progress:
+            progress(restored_decks, restored_cards)
+
+    return restored_decks, restored_cards
+
+def merge_backups(base, changes):
+    """Apply an incremental backup document on top of a full one, in place"""
+    if base.get('type') != 'full' or changes.get('type') != 'incremental':
+        raise ValueError('Expected a full backup followed by incremental ones.')
+    if changes['since'] > base['version']:
+        raise ValueError(f"Missing changes between versions {base['version']} and {changes['since']}.")
+
+    decks = {deck['id']: deck for deck in base['decks']}
+    cards = {deck_id: {card['id']: card for card in deck['cards']} for deck_id, deck in decks.items()}
+    card_decks = {card_id: deck_id for deck_id, deck_cards in cards.items() for card_id in deck_cards}
+
+    for deck_data in changes['decks']:
+        deck = decks.setdefault(deck_data['id'], {})
+        deck.update((key, value) for key, value in deck_data.items() if key != 'cards')
+        deck_cards = cards.setdefault(deck_data['id'], {})
+        for card in deck_data['cards']:
+            # A card that moved decks leaves its old one
+            cards.get(card_decks.get(card['id']), {}).pop(card['id'], None)
+            deck_cards[card['id']] = card
+            card_decks[card['id']] = deck_data['id']
+
+    deleted_decks = set(changes['deleted']['decks'])
+    deleted_cards = set(changes['deleted']['cards'])
+    base['decks'] = []
+    for deck_id in sorted(decks):
+        if deck_id in deleted_decks:
+            continue
+        deck = decks[deck_id]
+        deck['cards'] = sorted((card for card in cards[deck_id].values() if card['id'] not in deleted_cards),
+                               key=lambda card: (card.get('position') or '', card['id']))
+        base['decks'].append(deck)
+
+    base['version'] = changes['version']
+    base['export_date'] = changes['export_date']
+    return base
+
+@app.route('/restore_backup', methods=['POST'])
+@login_required
+def restore_backup_upload():
+    backup = request.files.get('backup')
+    if not backup or not backup.filename:
+        flash('Choose a NatureCards backup file to restore.', 'error')
+        return redirect(url_for('profile'))
 
-            if card.card_type == 'flashcard':
-                card_data['front'] = card.front
-                card_data['back'] = card.back
-            else:
-                card_data['content'] = card.content
+    job = enqueue_job('restore-backup', current_user.id, upload=backup)
+    return redirect(url_for('view_job', job_id=job.id))
 
-            deck_data['cards'].append(card_data)
+@app.route('/api/sync')
+@login_required
+def api_sync():
+    """Return decks, cards and deletions newer than the client's last seen version"""
+    since = request.args.get('since', 0, type=int)
+
+    # Read the counter first: anything committed after this is picked up by the next sync
+    version = current_user.sync_version
+
+    decks = active_decks().filter(Deck.user_id == current_user.id,
+                              Deck.version > since).order_by(Deck.version).all()
+    user_deck_ids = db.select(Deck.id).where(Deck.user_id == current_user.id, Deck.deleted_at.is_(None))
+    cards = Card.query.filter(Card.deck_id.in_(user_deck_ids),
+                              Card.version > since).order_by(Card.version).all()
+    tombstones = Tombstone.query.filter(Tombstone.user_id == current_user.id,
+                                        Tombstone.version > since).order_by(Tombstone.version).all()
+
+    return jsonify({
+        'since': since,
+        'version': version,
+        'decks': [deck.to_dict() for deck in decks],
+        'cards': [card.to_dict() for card in cards],
+        'deleted': {
+            'decks': [t.object_id for t in tombstones if t.object_type == 'deck'],
+            'cards': [t.object_id for t in tombstones if t.object_type == 'card']
+        }
+    })
 
-        export_data['decks'].append(deck_data)
+# How long a deleted deck can be brought back before the purge job removes it
+DECK_UNDO_WINDOW = timedelta(minutes=10)
+# Cards removed per transaction when purging a deleted deck
+DECK_PURGE_BATCH = 5000
 
-    # Return JSON file download
-    response = jsonify(export_data)
-    response.headers['Content-Disposition'] = f'attachment; filename=naturecards_backup_{current_user.username}.json'
-    return response
+def undoable_decks(user_id):
+    """A user's deleted decks that are still inside the undo window"""
+    return Deck.query.filter(Deck.user_id == user_id,
+                             Deck.deleted_at >= datetime.utcnow() - DECK_UNDO_WINDOW)
 
 @app.route('/delete_deck/<int:deck_id>')
 @login_required
 def delete_deck(deck_id):
-    deck = Deck.query.filter_by(id=deck_id, user_id=current_user.id).first_or_404()
-    db.session.delete(deck)
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    # Cards go with their deck, so a client drops them when it applies the deck tombstone
+    version = bump_sync_version(current_user.id)
+    record_deletion(current_user.id, version, 'deck', deck.id)
+    flashcards, notes = deck_card_type_counts(deck.id)
+    adjust_user_stats(current_user.id, decks=-1, flashcards=-flashcards, notes=-notes)
+    # Only the deck row is touched here; the purge-decks job removes its cards in chunks
+    deck.deleted_at = datetime.utcnow()
     db.session.commit()
-    flash('Deck deleted successfully!', 'success')
+    flash('Deck deleted. You can undo this from your decks page for the next few minutes.', 'success')
     return redirect(url_for('index'))
 
+@app.route('/deck/<int:deck_id>/undelete', methods=['POST'])
+@login_required
+def undelete_deck(deck_id):
+    deck = undoable_decks(current_user.id).filter(Deck.id == deck_id).first_or_404()
+    deck.deleted_at = None
+    # Clients dropped the deck and its cards with the tombstone, so both go out again
+    version = mark_changed(current_user.id, deck)
+    db.session.execute(db.update(Card).where(Card.deck_id == deck.id).values(version=version))
+    Tombstone.query.filter_by(user_id=current_user.id, object_type='deck', object_id=deck.id).delete()
+    flashcards, notes = deck_card_type_counts(deck.id)
+    adjust_user_stats(current_user.id, decks=1, flashcards=flashcards, notes=notes)
+    db.session.commit()
+    flash(f'Deck "{deck.name}" restored.', 'success')
+    return redirect(url_for('view_deck', deck_id=deck.id))
+
+def purge_deck(deck_id, batch_size=DECK_PURGE_BATCH):
+    """Delete a deleted deck's cards a chunk per transaction, then the deck; returns cards purged
+
+    Short transactions keep locks brief on large decks; each chunk's tags
+    and LSH bands go with it through ON DELETE CASCADE.
+    """
+    purged = 0
+    while True:
+        chunk = [card_id for card_id, in db.session.execute(
+            db.select(Card.id).where(Card.deck_id == deck_id).limit(batch_size))]
+        # Clones elsewhere keep the text they were sharing with these cards
+        materialize_clones(chunk)
+        db.session.execute(db.delete(Card).where(Card.id.in_(chunk)),
+                           execution_options={'synchronize_session': False})
+        db.session.commit()
+        purged += len(chunk)
+        if len(chunk) < batch_size:
+            break
+    db.session.execute(db.delete(Deck).where(Deck.id == deck_id),
+                       execution_options={'synchronize_session': False})
+    db.session.commit()
+    return purged
+
+def delete_cards(user_id, deck, card_ids):
+    """Delete some of a deck's cards with set-based statements; returns how many went
+
+    Tombstones are written with INSERT ... SELECT, and tags and LSH bands
+    follow the cards through ON DELETE CASCADE.
+    """
+    selected = db.and_(Card.deck_id == deck.id, Card.id.in_(card_ids))
+    counts = dict(db.session.query(Card.card_type, db.func.count(Card.id))
+                  .filter(selected).group_by(Card.card_type).all())
+    if not counts:
+        return 0
+
+    version = mark_changed(user_id, deck)
+    db.session.execute(db.insert(Tombstone).from_select(
+        ['user_id', 'object_type', 'object_id', 'version', 'deleted_at'],
+        db.select(db.literal(user_id), db.literal('card'), Card.id,
+                  db.literal(version), db.literal(datetime.utcnow())).where(selected)
+    ))
+    materialize_clones(db.select(Card.id).where(selected))
+    db.session.execute(db.delete(Card).where(selected), execution_options={'synchronize_session': False})
+    adjust_user_stats(user_id, flashcards=-counts.get('flashcard', 0), notes=-counts.get('note', 0))
+    return sum(counts.values())
+
+def move_cards(user_id, deck, target, card_ids):
+    """Move some of a deck's cards to the end of another deck, keeping their order"""
+    backfill_positions(deck.id)
+    moving = [card_id for card_id, in db.session.query(Card.id)
+              .filter(Card.deck_id == deck.id, Card.id.in_(card_ids))
+              .order_by(Card.position, Card.id)]
+    if not moving:
+        return 0
+
+    version = mark_changed(user_id, deck, target)
+    # Each card needs its own position in the new deck, so this is one
+    # executemany keyed by id rather than a single UPDATE
+    positions = positions_after(last_position(target.id), len(moving))
+    db.session.execute(db.update(Card), [
+        {'id': card_id, 'deck_id': target.id, 'position': position, 'version': version}
+        for card_id, position in zip(moving, positions)
+    ])
+    db.session.execute(db.update(CardSignatureBand)
+                       .where(CardSignatureBand.card_id.in_(moving))
+                       .values(deck_id=target.id))
+    return len(moving)
+
 @app.route('/delete_card/<int:card_id>')
 @login_required
 def delete_card(card_id):
     card = Card.query.get_or_404(card_id)
     # Verify user owns the deck this card belongs to
-    deck = Deck.query.filter_by(id=card.deck_id, user_id=current_user.id).first_or_404()
-    deck_id = card.deck_id
-    db.session.delete(card)
+    deck = active_decks().filter_by(id=card.deck_id, user_id=current_user.id).first_or_404()
+    delete_cards(current_user.id, deck, [card.id])
     db.session.commit()
     flash('Card deleted successfully!', 'success')
-    return redirect(url_for('view_deck', deck_id=deck_id))
+    return redirect(url_for('view_deck', deck_id=deck.id))
+
+@app.route('/deck/<int:deck_id>/cards/delete', methods=['POST'])
+@login_required
+def delete_selected_cards(deck_id):
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    deleted = delete_cards(current_user.id, deck, request.form.getlist('card_id', type=int))
+    db.session.commit()
+
+    if deleted:
+        flash(f'Deleted {deleted} cards.', 'success')
+    else:
+        flash('Select the cards you want to delete first.', 'info')
+    return redirect(url_for('view_deck', deck_id=deck.id))
+
+@app.route('/deck/<int:deck_id>/cards/move', methods=['POST'])
+@login_required
+def move_selected_cards(deck_id):
+    deck = active_decks().filter_by(id=deck_id, user_id=current_user.id).first_or_404()
+    target_name = request.form.get('target_deck_name', '').strip()
+    if target_name:
+        target = active_decks().filter_by(user_id=current_user.id, name=target_name).first()
+        if not target:
+            flash(f'No deck named "{target_name}".', 'error')
+            return redirect(url_for('view_deck', deck_id=deck.id))
+    else:
+        target = active_decks().filter_by(id=request.form.get('target_deck_id', type=int),
+                                      user_id=current_user.id).first_or_404()
+    if target.id == deck.id:
+        flash('Those cards are already in this deck.', 'info')
+        return redirect(url_for('view_deck', deck_id=deck.id))
+
+    moved = move_cards(current_user.id, deck, target, request.form.getlist('card_id', type=int))
+    db.session.commit()
+
+    if moved:
+        flash(f'Moved {moved} cards to {target.name}.', 'success')
+    else:
+        flash('Select the cards you want to move first.', 'info')
+    return redirect(url_for('view_deck', deck_id=deck.id))
+
+class Job(db.Model):
+    """Background work queued in the database and run by whichever worker claims it"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # None for maintenance jobs
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    payload = db.Column(db.Text)
+    result = db.Column(db.Text)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    message = db.Column(db.String(200))
+    worker = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status_created', 'status', 'created_at'),
+        db.Index('ix_job_user_created', 'user_id', 'created_at'),
+        db.Index('ix_job_kind_created', 'kind', 'created_at'),
+    )
+
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'message': self.message,
+            'result': json.loads(self.result) if self.result else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+        # Progress this process could not write past the job's own transaction
+        if self.status == 'running' and self.id in _job_progress:
+            data.update(_job_progress[self.id])
+        return data
+
+class JobFile(db.Model):
+    """Upload a job works on, kept in the database so a worker on any host can read it"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id', ondelete='CASCADE'), nullable=False, unique=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+class LeaderLease(db.Model):
+    """Time-limited claim on a role that only one process may hold at a time"""
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(100), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+# Worker threads per process (0 leaves jobs to `flask run-jobs`), and idle poll interval
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_POLL_SECONDS = 5
+# How long finished jobs are kept
+JOB_RETENTION = timedelta(days=14)
+# Running jobs older than this belonged to a worker that went away
+JOB_STALE_AFTER = timedelta(hours=6)
+LEADER_LEASE_SECONDS = 60
+
+# Maintenance the leader queues: job kind -> interval between runs
+PERIODIC_JOBS = {
+    'backfill-keywords': timedelta(hours=1),
+    'backfill-hashes': timedelta(hours=1),
+    'backfill-positions': timedelta(hours=1),
+    'rebuild-stats': timedelta(days=1),
+    'purge-jobs': timedelta(days=1),
+    'purge-decks': DECK_UNDO_WINDOW,
+}
+
+JOB_HANDLERS = {}
+_job_progress = {}
+_job_wakeup = threading.Event()
+_job_threads = []
+_job_threads_lock = threading.Lock()
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def job_handler(kind):
+    """Register function(job, payload, progress) to run jobs of a kind and return their result"""
+    def register(function):
+        JOB_HANDLERS[kind] = function
+        return function
+    return register
+
+def enqueue_job(kind, user_id=None, upload=None, **payload):
+    """Queue a job and commit it so any worker can pick it up
+
+    An uploaded file is stored alongside the job rather than on local disk,
+    since the worker that runs it may be a separate process on another host.
+    """
+    job = Job(kind=kind, user_id=user_id, payload=json.dumps(payload))
+    db.session.add(job)
+    if upload is not None:
+        db.session.flush()
+        db.session.add(JobFile(job_id=job.id, data=upload.read()))
+    db.session.commit()
+    _job_wakeup.set()
+    return job
+
+def open_job_file(job):
+    """The job's uploaded file as a binary stream"""
+    data = db.session.query(JobFile.data).filter_by(job_id=job.id).scalar()
+    if data is None:
+        raise ValueError('The uploaded file is no longer available; please upload it again.')
+    return io.BytesIO(data)
+
+def report_job_progress(job_id, progress, total=None, message=None):
+    """Record progress from inside a running job, outside the job's own transaction"""
+    values = {'progress': progress}
+    if total is not None:
+        values['total'] = total
+    if message is not None:
+        values['message'] = message[:200]
+    _job_progress[job_id] = values
+
+    try:
+        with db.engine.connect() as connection:
+            sqlite = connection.dialect.name == 'sqlite'
+            if sqlite:
+                # SQLite has one writer; while the job's transaction holds the
+                # lock, skip the write and leave _job_progress to answer
+                connection.exec_driver_sql('PRAGMA busy_timeout = 0')
+            try:
+                connection.execute(db.update(Job).where(Job.id == job_id).values(**values))
+                connection.commit()
+            finally:
+                if sqlite:
+                    connection.exec_driver_sql('PRAGMA busy_timeout = 5000')
+    except OperationalError:
+        pass
+
+def claim_next_job():
+    """Take the oldest queued job, or None; a compare-and-set keeps two workers off one job"""
+    while True:
+        job_id = (db.session.query(Job.id).filter(Job.status == 'queued')
+                  .order_by(Job.created_at, Job.id).limit(1).scalar())
+        if job_id is None:
+            return None
+        claimed = db.session.execute(
+            db.update(Job)
+            .where(Job.id == job_id, Job.status == 'queued')
+            .values(status='running', worker=worker_id(), started_at=datetime.utcnow())
+        )
+        db.session.commit()
+        if claimed.rowcount == 1:
+            return db.session.get(Job, job_id)
+
+def run_job(job):
+    """Run a claimed job; its work and its final status commit together"""
+    job_id = job.id
+
+    def progress(done, total=None, message=None):
+        report_job_progress(job_id, done, total, message)
+
+    try:
+        handler = JOB_HANDLERS.get(job.kind)
+        if handler is None:
+            raise ValueError(f'No handler for {job.kind} jobs')
+        result = handler(job, json.loads(job.payload or '{}'), progress)
+        for key, value in _job_progress.get(job_id, {}).items():
+            setattr(job, key, value)
+        job.status = 'done'
+        job.result = json.dumps(result)
+        if job.total:
+            job.progress = job.total
+    except Exception as e:
+        app.logger.exception('Job %s (%s) failed', job_id, job.kind)
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.status = 'failed'
+        job.message = str(e)[:200]
+    finally:
+        _job_progress.pop(job_id, None)
+
+    job.finished_at = datetime.utcnow()
+    # The upload is only needed while the job runs
+    db.session.execute(db.delete(JobFile).where(JobFile.job_id == job_id))
+    db.session.commit()
+    return job
+
+def acquire_leadership(name='maintenance'):
+    """Take or renew a lease; True while this process holds it"""
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=LEADER_LEASE_SECONDS)
+    renewed = db.session.execute(
+        db.update(LeaderLease)
+        .where(LeaderLease.name == name,
+               db.or_(LeaderLease.holder == worker_id(), LeaderLease.expires_at < now))
+        .values(holder=worker_id(), expires_at=expires_at)
+    )
+    if renewed.rowcount == 0:
+        try:
+            db.session.add(LeaderLease(name=name, holder=worker_id(), expires_at=expires_at))
+            db.session.flush()
+        except IntegrityError:  # someone else holds it
+            db.session.rollback()
+            return False
+    db.session.commit()
+    return True
+
+def schedule_periodic_jobs(now):
+    """Queue each maintenance job whose last run is older than its interval"""
+    for kind, interval in PERIODIC_JOBS.items():
+        last_run = db.session.query(db.func.max(Job.created_at)).filter(Job.kind == kind).scalar()
+        if last_run is None or now - last_run >= interval:
+            enqueue_job(kind)
+
+def job_worker_loop():
+    while True:
+        with app.app_context():
+            try:
+                job = claim_next_job()
+                if job is not None:
+                    run_job(job)
+                    continue
+            except Exception:
+                app.logger.exception('Job worker error')
+                db.session.rollback()
+        _job_wakeup.wait(JOB_POLL_SECONDS)
+        _job_wakeup.clear()
+
+def job_scheduler_loop():
+    while True:
+        with app.app_context():
+            try:
+                if acquire_leadership():
+                    schedule_periodic_jobs(datetime.utcnow())
+            except Exception:
+                app.logger.exception('Job scheduler error')
+                db.session.rollback()
+        time.sleep(LEADER_LEASE_SECONDS / 3)
+
+def start_job_runner(workers=JOB_WORKERS):
+    """Start this process's worker threads and maintenance scheduler, once"""
+    with _job_threads_lock:
+        if _job_threads or workers <= 0:
+            return
+        targets = [job_worker_loop] * workers + [job_scheduler_loop]
+        for number, target in enumerate(targets):
+            thread = threading.Thread(target=target, name=f'jobs-{number}', daemon=True)
+            thread.start()
+            _job_threads.append(thread)
+
+@app.before_request
+def ensure_job_runner():
+    # Started lazily so each gunicorn worker gets its own threads after forking
+    if not _job_threads:
+        start_job_runner()
+
+def backfill_keywords(batch_size=CARD_INSERT_BATCH):
+    """Store keywords for notes saved before they were kept in the database"""
+    updated = 0
+    while True:
+        notes = (db.session.query(Card.id, Card.content)
+                 .filter(Card.card_type == 'note', Card.keyword.is_(None),
+                         Card.content.isnot(None), Card.content != '')
+                 .limit(batch_size).all())
+        if not notes:
+            return updated
+        db.session.execute(db.update(Card), [{'id': card_id, 'keyword': note_keyword(content)}
+                                             for card_id, content in notes])
+        updated += len(notes)
+
+def backfill_content_hashes(batch_size=CARD_INSERT_BATCH):
+    """Hash cards saved before duplicate detection, and LSH-index their notes
+
+    Commits after each batch, so a large library is not one long transaction.
+    """
+    updated = 0
+    while True:
+        cards = (db.session.query(Card.id, Card.deck_id, Card.card_type, Card.front, Card.back, Card.content)
+                 .filter(Card.content_hash.is_(None))
+                 .limit(batch_size).all())
+        if not cards:
+            return updated
+        db.session.execute(db.update(Card), [
+            {'id': card_id, 'content_hash': card_content_hash(card_type, front, back, content)}
+            for card_id, deck_id, card_type, front, back, content in cards
+        ])
+        bands = [band for card_id, deck_id, card_type, front, back, content in cards if card_type == 'note'
+                 for band in signature_band_rows(card_id, deck_id, content)]
+        if bands:
+            db.session.execute(db.insert(CardSignatureBand), bands)
+        db.session.commit()
+        updated += len(cards)
+
+@job_handler('restore-backup')
+def restore_backup_job(job, payload, progress):
+    backup = open_job_file(job)
+    total = len(backup.getbuffer())
+
+    def report(decks, cards):
+        progress(backup.tell(), total, f'{cards} cards restored across {decks} decks')
+
+    try:
+        decks, cards = restore_backup(job.user_id, backup, progress=report)
+    except (UnicodeDecodeError, json.JSONDecodeError, OSError, EOFError):
+        raise ValueError('That file is not a valid NatureCards backup.')
+    return {'decks': decks, 'cards': cards}
+
+@job_handler('import-anki')
+def import_anki_job(job, payload, progress):
+    package = open_job_file(job)
+    try:
+        deck, created = import_anki_package(
+            job.user_id, package, payload['name'],
+            progress=lambda cards: progress(cards, message=f'{cards} cards imported'))
+    except (zipfile.BadZipFile, sqlite3.Error):
+        raise ValueError('That file is not an Anki package (.apkg).')
+    return {'deck_id': deck.id, 'deck': deck.name, 'cards': created}
+
+@job_handler('backfill-keywords')
+def backfill_keywords_job(job, payload, progress):
+    return {'notes': backfill_keywords()}
+
+@job_handler('backfill-hashes')
+def backfill_hashes_job(job, payload, progress):
+    return {'cards': backfill_content_hashes()}
+
+@job_handler('backfill-positions')
+def backfill_positions_job(job, payload, progress):
+    return {'cards': backfill_positions()}
+
+@job_handler('rebuild-stats')
+def rebuild_stats_job(job, payload, progress):
+    rebuild_user_stats()
+    return {}
+
+@job_handler('purge-jobs')
+def purge_jobs_job(job, payload, progress):
+    now = datetime.utcnow()
+    stale = db.session.execute(
+        db.update(Job)
+        .where(Job.status == 'running', Job.started_at < now - JOB_STALE_AFTER)
+        .values(status='failed', message='The worker running this job stopped.', finished_at=now)
+    ).rowcount
+    # Uploads left behind by jobs that will never run again
+    db.session.execute(db.delete(JobFile).where(
+        JobFile.job_id.in_(db.select(Job.id).where(Job.status.in_(('done', 'failed'))))))
+    purged = db.session.execute(
+        db.delete(Job).where(Job.status.in_(('done', 'failed')), Job.finished_at < now - JOB_RETENTION)
+    ).rowcount
+    return {'stale': stale, 'purged': purged}
+
+@job_handler('purge-decks')
+def purge_decks_job(job, payload, progress):
+    # Only decks past the undo window, so an undo never races a purge
+    cutoff = datetime.utcnow() - DECK_UNDO_WINDOW
+    deck_ids = [deck_id for deck_id, in db.session.query(Deck.id).filter(Deck.deleted_at < cutoff)]
+    cards = 0
+    for done, deck_id in enumerate(deck_ids, 1):
+        cards += purge_deck(deck_id)
+        progress(done, len(deck_ids))
+    return {'decks': len(deck_ids), 'cards': cards}
+
+# Labels for the job status page
+JOB_TITLES = {
+    'restore-backup': '📤 Restoring backup',
+    'import-anki': '📦 Importing Anki deck',
+}
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+def view_job(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    return render_template('job.html', job=job, title=JOB_TITLES.get(job.kind, job.kind))
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def api_job(job_id):
+    """Status and progress of one of the user's jobs"""
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs')
+@login_required
+def api_jobs():
+    """The user's most recent jobs, newest first"""
+    jobs = (Job.query.filter_by(user_id=current_user.id)
+            .order_by(Job.created_at.desc(), Job.id.desc()).limit(20))
+    return jsonify({'jobs': [job.to_dict() for job in jobs]})
+
+@app.cli.command('backfill-positions')
+def backfill_positions_command():
+    """Give every card saved before manual ordering a position"""
+    updated = backfill_positions()
+    db.session.commit()
+    print(f"✅ Positioned {updated} cards")
+
+@app.cli.command('backfill-hashes')
+def backfill_hashes_command():
+    """Hash and LSH-index every card saved before duplicate detection"""
+    updated = backfill_content_hashes()
+    print(f"✅ Indexed {updated} cards for duplicate detection")
+
+@app.cli.command('restore-backup')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', required=True, help='Account to restore into')
+def restore_backup_command(path, username):
+    """Restore a JSON (or .json.gz) backup file into a user's account"""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'No user named {username}')
+
+    def report(decks, cards):
+        print(f"🌿 {decks} decks, {cards} cards so far...")
+
+    with open(path, 'rb') as backup:
+        try:
+            decks, cards = restore_backup(user.id, backup, progress=report)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    db.session.commit()
+    print(f"✅ Restored {cards} cards across {decks} decks for {username}")
+
+@app.cli.command('merge-backup')
+@click.argument('base', type=click.Path(exists=True, dir_okay=False))
+@click.argument('changes', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', required=True, type=click.Path(dir_okay=False),
+              help='Where to write the merged full backup (.gz to compress)')
+def merge_backup_command(base, changes, output):
+    """Fold incremental backups, oldest first, into a full backup"""
+    def load(path):
+        with open(path, 'rb') as backup:
+            return json.load(open_backup(backup))
+
+    merged = load(base)
+    try:
+        for path in changes:
+            merged = merge_backups(merged, load(path))
+    except (KeyError, ValueError) as e:
+        raise click.ClickException(f'{path}: {e}')
+
+    with (gzip.open if output.endswith('.gz') else open)(output, 'wt', encoding='utf-8') as target:
+        json.dump(merged, target)
+    print(f"✅ Wrote a full backup at version {merged['version']} to {output}")
+
+@app.cli.command('run-jobs')
+@click.option('--workers', default=2, show_default=True, help='Worker threads to run')
+def run_jobs_command(workers):
+    """Run background jobs and periodic maintenance in this process until stopped"""
+    start_job_runner(workers)
+    print(f"🌿 Running {workers} job workers (Ctrl+C to stop)")
+    for thread in list(_job_threads):
+        thread.join()
+
+def add_column_ddl(table, column, dialect):
+    """ALTER TABLE statement adding a model column to an existing table"""
+    preparer = dialect.identifier_preparer
+    ddl = f'{preparer.format_column(column)} {column.type.compile(dialect=dialect)}'
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if default is not None:
+        # Existing rows get the model default, so NOT NULL counters can be added
+        literal = db.literal(default, type_=column.type).compile(dialect=dialect,
+                                                                 compile_kwargs={'literal_binds': True})
+        ddl += f' DEFAULT {literal}'
+    if not column.nullable:
+        ddl += ' NOT NULL'
+    for foreign_key in column.foreign_keys:
+        ddl += f' REFERENCES {preparer.quote(foreign_key.column.table.name)} ({preparer.quote(foreign_key.column.name)})'
+    if_not_exists = 'IF NOT EXISTS ' if dialect.name == 'postgresql' else ''
+    return f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {if_not_exists}{ddl}'
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Bring a database created by an earlier version up to the current schema, keeping its data"""
+    dialect = db.engine.dialect
+    had_stats = db.inspect(db.engine).has_table(UserStats.__tablename__)
+    # New tables come with their indexes
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    added = set()
+    indexes = 0
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.execute(db.text(add_column_ddl(table, column, dialect)))
+                    added.add((table.name, column.name))
+        if dialect.name == 'postgresql':
+            position = next(column for column in inspector.get_columns('card') if column['name'] == 'position')
+            if getattr(position['type'], 'length', None):
+                # Keys outgrew the original VARCHAR(64)
+                connection.execute(db.text('ALTER TABLE card ALTER COLUMN position TYPE TEXT COLLATE "C"'))
+        if ('deck', 'version') in added or ('card', 'version') in added:
+            # Rows from before sync carry version 0, which a first sync (since=0) would skip
+            connection.execute(db.update(Deck).where(Deck.version == 0).values(version=1))
+            connection.execute(db.update(Card.__table__).where(Card.version == 0).values(version=1))
+            connection.execute(db.update(User).where(User.sync_version == 0).values(sync_version=1))
+        for table in db.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+                    indexes += 1
+    print(f"✅ Added {len(added)} columns and {indexes} indexes")
+    if dialect.name == 'postgresql':
+        print(f"✅ Upgraded {upgrade_cascade_foreign_keys()} foreign keys to ON DELETE CASCADE")
+
+    if not had_stats:
+        users = rebuild_user_stats()
+        db.session.commit()
+        print(f"✅ Counted profile statistics for {users} users")
+
+# Card foreign keys that cascade deletes: (table, column, referenced table)
+CASCADE_FOREIGN_KEYS = [
+    ('card', 'deck_id', 'deck'),
+    ('card_tag', 'card_id', 'card'),
+    ('card_tag', 'tag_id', 'tag'),
+    ('card_signature_band', 'card_id', 'card'),
+    ('card_signature_band', 'deck_id', 'deck'),
+]
+
+def upgrade_cascade_foreign_keys():
+    """Recreate card foreign keys with ON DELETE CASCADE (PostgreSQL); returns how many changed"""
+    inspector = db.inspect(db.engine)
+    upgraded = 0
+    with db.engine.begin() as connection:
+        for table, column, referenced in CASCADE_FOREIGN_KEYS:
+            for foreign_key in inspector.get_foreign_keys(table):
+                if foreign_key['constrained_columns'] != [column]:
+                    continue
+                if (foreign_key.get('options') or {}).get('ondelete', '').upper() == 'CASCADE':
+                    continue
+                name = foreign_key['name']
+                connection.execute(db.text(f'ALTER TABLE {table} DROP CONSTRAINT {name}'))
+                connection.execute(db.text(
+                    f'ALTER TABLE {table} ADD CONSTRAINT {name} FOREIGN KEY ({column}) '
+                    f'REFERENCES {referenced} (id) ON DELETE CASCADE'))
+                upgraded += 1
+    return upgraded
+
+@app.cli.command('upgrade-cascades')
+def upgrade_cascades_command():
+    """Recreate card foreign keys with ON DELETE CASCADE on a PostgreSQL database created before them"""
+    if db.engine.dialect.name != 'postgresql':
+        print("🌿 SQLite cannot alter foreign keys; run reset_db.py or restore a backup into a fresh database")
+        return
+    print(f"✅ Upgraded {upgrade_cascade_foreign_keys()} foreign keys to ON DELETE CASCADE")
+
+@app.cli.command('init-search')
+def init_search_command():
+    """Create (or rebuild) the full-text search index on an existing database"""
+    global _search_backend, _search_fallback_until
+    with db.engine.begin() as connection:
+        install_search_index(connection, rebuild=True)
+    _search_backend, _search_fallback_until = None, 0
+    print(f"✅ Search index ready ({db.engine.dialect.name})")
+
+@app.cli.command('rebuild-study-rollups')
+def rebuild_study_rollups_command():
+    """Recompute the daily study rollups from the raw study events"""
+    rows = rebuild_study_rollups()
+    db.session.commit()
+    print(f"✅ Rebuilt {rows} daily study rollups")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recount every user's profile statistics in bulk"""
+    users = rebuild_user_stats()
+    db.session.commit()
+    print(f"✅ Rebuilt statistics for {users} users")
 
 if __name__ == '__main__':
     with app.app_context():